@@ -2,8 +2,12 @@
 # copyright notices and license terms.
 from trytond.pool import Pool
 from . import activity
+from . import attachment
+from . import company
 from . import electronic_mail
 from . import configuration
+from . import party
+from . import statistic
 from . import user
 
 def register():
@@ -11,10 +15,19 @@ def register():
         activity.Activity,
         activity.Cron,
         electronic_mail.ElectronicMail,
+        electronic_mail.ElectronicMailAddress,
+        electronic_mail.ElectronicMailThread,
         user.User,
         configuration.Configuration,
+        configuration.AttachmentDeduplicationStart,
         activity.ActivityType,
+        attachment.Attachment,
+        company.Company,
+        company.Employee,
+        party.ContactMechanism,
+        statistic.ActivityMailStatistic,
         module='electronic_mail_activity', type_='model')
     Pool.register(
         activity.ActivityReplyMail,
+        configuration.AttachmentDeduplication,
         module='electronic_mail_activity', type_='wizard')
@@ -1,26 +1,42 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from datetime import datetime
-from html2text import html2text
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from sql import Literal, Null, Window
+from sql.conditionals import Case
+from sql.functions import RowNumber
+from sql.operators import Concat
 from trytond.pool import Pool, PoolMeta
-from trytond.model import fields, ModelView, Unique
-from trytond.transaction import Transaction
+from trytond.model import fields, ModelView, Unique, Index
+from trytond.transaction import Transaction, without_check_access
+from trytond.cache import Cache
 from trytond.wizard import Wizard, StateAction
 from trytond.pyson import Eval, Bool
 from email.utils import formataddr, formatdate, make_msgid, getaddresses
-from email import encoders
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
+from smtplib import SMTPException
 import mimetypes
 import logging
+import re
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.config import config
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.modules.electronic_mail.electronic_mail import _make_header
 from trytond.modules.widgets import tools
+from .mime import html_to_text, base64_payload
+from .smtp import smtp_pool, server_key
+from .statistic import stage
 
 QUEUE_NAME = config.get('electronic_mail', 'queue_name', default='default')
+QUOTE_PREFIX = re.compile(r'[>\s]*')
+Recipients = namedtuple('Recipients', ['from_', 'to', 'cc', 'bcc', 'emails'])
+SEND_RETRIES = config.getint('electronic_mail', 'activity_send_retries',
+    default=3)
+SEND_RETRY_DELAY = config.getint('electronic_mail',
+    'activity_send_retry_delay', default=60)
 
 
 class Cron(metaclass=PoolMeta):
@@ -30,26 +46,55 @@ class Cron(metaclass=PoolMeta):
     def __setup__(cls):
         super().__setup__()
         cls.method.selection.extend([
-            ('activity.activity|create_activity', "Create Activity")])
+            ('activity.activity|create_activity', "Create Activity"),
+            ('activity.mail.statistic|purge',
+                "Purge Activity Mail Statistics"),
+            ])
 
 
 class Activity(metaclass=PoolMeta):
     __name__ = 'activity.activity'
 
+    _internal_emails_cache = Cache('activity.activity.internal_emails',
+        context=False)
     mail = fields.Many2One('electronic.mail', "Related Mail", readonly=True,
             ondelete='CASCADE')
     in_reply_to = fields.Function(fields.Char('In-Reply-To'),
-        'get_in_reply_to')
+        'get_thread_values')
     references = fields.Function(fields.Char('References'),
-        'get_references')
+        'get_thread_values')
     original_mail_message_id = fields.Function(
         fields.Char('Original Mail Message-ID'),
-        'get_original_mail_message_id')
-    have_mail = fields.Function(fields.Boolean('Have mail'), 'get_have_mail')
+        'get_thread_values')
+    have_mail = fields.Function(fields.Boolean('Have mail'), 'get_have_mail',
+        searcher='search_have_mail')
     related_activity = fields.Many2One('activity.activity', 'Related activity')
-    mail_content = fields.Function(fields.Binary('Mail Content', filename='filename',
-        states={'invisible': ~Bool(Eval('have_mail'))}), 'get_mail_content')
+    mail_content = fields.Function(fields.Binary('Mail Content',
+            filename='filename',
+            states={'invisible': ~Bool(Eval('have_mail'))},
+            help="The preview of the mail.\n"
+            "Its size is the size of the whole raw mail."),
+        'get_mail_content')
     filename = fields.Function(fields.Char("File Name"), 'get_filename')
+    mail_state = fields.Selection([
+            (None, ''),
+            ('queued', "Queued"),
+            ('sent', "Sent"),
+            ('failed', "Failed"),
+            ], "Mail State", readonly=True)
+    mail_attempts = fields.Integer("Mail Attempts", readonly=True)
+    mail_error = fields.Text("Mail Error", readonly=True,
+        states={
+            'invisible': ~Eval('mail_error'),
+            })
+    mail_body_referenced = fields.Boolean("Mail Body Referenced",
+        readonly=True,
+        help="The description is only an excerpt of the body of the mail.")
+    full_description = fields.Function(fields.Text("Full Description",
+            states={
+                'invisible': ~Eval('mail_body_referenced'),
+                }),
+        'get_full_description')
 
     @classmethod
     def __setup__(cls):
@@ -60,6 +105,12 @@ class Activity(metaclass=PoolMeta):
             ('mail_unique', Unique(t, t.mail),
                 'electronic_mail_activity.msg_electronic_mail_unique'),
             ]
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.resource, Index.Equality()),
+                    (t.dtstart, Index.Range())),
+                Index(t, (t.origin, Index.Equality())),
+                })
 
         cls._buttons.update({
                 'new': {
@@ -75,6 +126,26 @@ class Activity(metaclass=PoolMeta):
                     },
             })
 
+    @classmethod
+    def create(cls, vlist):
+        Thread = Pool().get('electronic.mail.thread')
+        activities = super().create(vlist)
+        Thread.update_activities([a for a, v in zip(activities, vlist)
+                if v.get('mail')])
+        return activities
+
+    @classmethod
+    def write(cls, *args):
+        Thread = Pool().get('electronic.mail.thread')
+        super().write(*args)
+        actions = iter(args)
+        to_update = []
+        for activities, values in zip(actions, actions):
+            if 'mail' in values:
+                to_update.extend(activities)
+        if to_update:
+            Thread.update_activities(to_update)
+
     @classmethod
     def copy(cls, activities, default=None):
         if default is None:
@@ -82,16 +153,24 @@ class Activity(metaclass=PoolMeta):
         else:
             default = default.copy()
         default.setdefault('mail')
+        default.setdefault('mail_state')
+        default.setdefault('mail_attempts')
+        default.setdefault('mail_error')
+        default.setdefault('mail_body_referenced')
+        if 'description' not in default:
+            # The copies do not reference the mail so they get the body
+            descriptions = {a.id: a.full_description
+                for a in cls.browse(list(map(int, activities)))
+                if a.mail_body_referenced}
+            if descriptions:
+                default['description'] = lambda data: descriptions.get(
+                    data['id'], data['description'])
         return super().copy(activities, default=default)
 
     @property
     def message_id(self):
         return self.mail and self.mail.message_id or make_msgid()
 
-    def get_in_reply_to(self, name):
-        thread_mail = self.mail or self.get_previous_mail()
-        return thread_mail and thread_mail.message_id or ""
-
     def get_html(self, name):
         pool = Pool()
         ElectronicMail = pool.get('electronic.mail')
@@ -103,23 +182,78 @@ class Activity(metaclass=PoolMeta):
     def _get_origin(cls):
         return super()._get_origin() + ['electronic.mail']
 
-    def get_references(self, name):
-        thread_mail = self.mail or self.get_previous_mail()
-        if not thread_mail:
-            return ""
+    @classmethod
+    def get_thread_values(cls, activities, names):
+        thread_mails = cls.get_thread_mails(activities)
+        result = {n: {} for n in names}
+        for activity in activities:
+            thread_mail = thread_mails.get(activity.id)
+            message_id = thread_mail and thread_mail.message_id or ""
+            if 'in_reply_to' in names:
+                result['in_reply_to'][activity.id] = message_id
+            if 'original_mail_message_id' in names:
+                result['original_mail_message_id'][activity.id] = message_id
+            if 'references' in names:
+                references = []
+                if thread_mail:
+                    if thread_mail.references:
+                        references = thread_mail.references.split()
+                    elif thread_mail.in_reply_to:
+                        references = [thread_mail.in_reply_to]
+                    if (thread_mail.message_id
+                            and thread_mail.message_id not in references):
+                        references.append(thread_mail.message_id)
+                result['references'][activity.id] = " ".join(references)
+        return result
 
-        references = []
-        if thread_mail.references:
-            references = thread_mail.references.split()
-        elif thread_mail.in_reply_to:
-            references = [thread_mail.in_reply_to]
-        if thread_mail.message_id and thread_mail.message_id not in references:
-            references.append(thread_mail.message_id)
-        return " ".join(references)
+    @classmethod
+    def get_thread_mails(cls, activities):
+        """Return a dictionary with the mail of the thread of each activity
 
-    def get_original_mail_message_id(self, name):
-        thread_mail = self.mail or self.get_previous_mail()
-        return thread_mail and thread_mail.message_id or ""
+        It is the mail of the activity, the one of its related activity or
+        the last mail of another activity of the same resource.
+        """
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result, to_search = {}, []
+        for activity in activities:
+            if activity.mail:
+                result[activity.id] = activity.mail.id
+            elif activity.related_activity and activity.related_activity.mail:
+                result[activity.id] = activity.related_activity.mail.id
+            elif activity.resource:
+                to_search.append(activity)
+
+        # The two last mails of each resource are enough to skip the
+        # activity itself
+        last_mails = defaultdict(list)
+        resources = {str(a.resource) for a in to_search}
+        for sub_resources in grouped_slice(resources):
+            query = table.select(
+                table.resource, table.id, table.mail,
+                RowNumber(window=Window([table.resource],
+                        order_by=[table.dtstart.desc, table.id.desc])
+                    ).as_('rank'),
+                where=table.resource.in_(list(sub_resources))
+                & (table.mail != Null))
+            cursor.execute(*query.select(
+                    query.resource, query.id, query.mail,
+                    where=query.rank <= 2,
+                    order_by=[query.rank.asc]))
+            for resource, activity_id, mail_id in cursor:
+                last_mails[resource].append((activity_id, mail_id))
+        for activity in to_search:
+            for activity_id, mail_id in last_mails[str(activity.resource)]:
+                if activity_id != activity.id:
+                    result[activity.id] = mail_id
+                    break
+
+        mails = ElectronicMail.browse(set(result.values()))
+        mails = {m.id: m for m in mails}
+        return {a: mails[m] for a, m in result.items()}
 
     def get_previous_mail(self):
         if self.related_activity and self.related_activity.mail:
@@ -140,16 +274,81 @@ class Activity(metaclass=PoolMeta):
 
     @classmethod
     def get_have_mail(cls, activities, name):
-        result = {}
-        for activity in activities:
-            result[activity.id] = activity.mail and True or False
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {a.id: False for a in activities}
+        for sub_ids in grouped_slice(list(result)):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.mail != Null)))
+            result.update((i, True) for i, in cursor)
         return result
 
-    def get_mail_content(self, name):
+    @classmethod
+    def search_have_mail(cls, name, clause):
+        _, operator, value = clause[:3]
+        if operator in {'=', '!='}:
+            values = {bool(value)}
+        elif operator in {'in', 'not in'}:
+            values = {bool(v) for v in value}
+        else:
+            raise ValueError(
+                "Unsupported operator %r for have_mail" % operator)
+        if operator in {'!=', 'not in'}:
+            values = {True, False} - values
+        if values == {True, False}:
+            return []
+        elif values == {True}:
+            return [('mail', '!=', None)]
+        elif values == {False}:
+            return [('mail', '=', None)]
+        return [('id', 'in', [])]
+
+    @staticmethod
+    def order_have_mail(tables):
+        table, _ = tables[None]
+        return [Case((table.mail != Null, Literal(True)),
+                else_=Literal(False))]
+
+    @classmethod
+    def get_mail_content(cls, activities, name):
         pool = Pool()
         ElectronicMail = pool.get('electronic.mail')
-        if isinstance(self.origin, ElectronicMail):
-            return (self.origin.preview or '').encode('utf-8')
+
+        mails = {a.id: a.origin for a in activities
+            if isinstance(a.origin, ElectronicMail)}
+        result = {a.id: None for a in activities}
+        size = (Transaction().context.get('%s.%s' % (cls.__name__, name))
+            == 'size')
+        if size and 'size' in ElectronicMail._fields:
+            # Use the size stored on the mail to not render the previews, it
+            # is the size of the raw mail and not of the preview
+            sizes = {m['id']: m['size'] for m in ElectronicMail.read(
+                    list({m.id for m in mails.values()}), ['size'])}
+            for activity_id, mail in mails.items():
+                result[activity_id] = sizes[mail.id] or 0
+        elif size:
+            for activity_id, mail in mails.items():
+                result[activity_id] = len((mail.preview or '').encode('utf-8'))
+        else:
+            for activity_id, mail in mails.items():
+                result[activity_id] = (mail.preview or '').encode('utf-8')
+        return result
+
+    @classmethod
+    def get_full_description(cls, activities, name):
+        "Return the description with the whole body of the referenced mails"
+        ElectronicMail = Pool().get('electronic.mail')
+
+        referenced = [a for a in activities
+            if a.mail_body_referenced and a.mail]
+        bodies = ElectronicMail.get_activity_descriptions(
+            list({a.mail for a in referenced}))
+        result = {a.id: a.description for a in activities}
+        for activity in referenced:
+            result[activity.id] = bodies.get(activity.mail.id)
+        return result
 
     def get_filename(self, name):
         return 'mail-content.html'
@@ -164,7 +363,7 @@ class Activity(metaclass=PoolMeta):
                     raise UserError(gettext(
                         'electronic_mail_activity.mail_received',
                             activity=activity.id))
-                cls.send_mail(activity, user)
+            cls.queue_mails(activities)
 
     @classmethod
     @ModelView.button_action('electronic_mail_activity.wizard_replymail')
@@ -174,14 +373,11 @@ class Activity(metaclass=PoolMeta):
     @classmethod
     @ModelView.button
     def guess(cls, activities):
-        activities = cls.browse(sorted(activities, key=lambda x: x.id))
-        for activity in activities:
-            activity = cls(activity)
-            activity.guess_resource()
-            activity.guess_contacts()
-            # Each activity is saved because in this list there
-            # could be a resource of another of the same list
-            activity.save()
+        with stage('guess', len(activities)):
+            activities = cls.browse(sorted(activities, key=lambda x: x.id))
+            cls.guess_resources(activities)
+            cls.guess_activities_contacts(activities)
+            cls.save(activities)
 
     @classmethod
     def check_activity_user_info(cls):
@@ -203,73 +399,197 @@ class Activity(metaclass=PoolMeta):
         Send out the given email using the SMTP_CLIENT if configured in the
         Tryton Server configuration
 
-        :param email_id: Browse record of the email to be sent
-        :param server: Browse Record of the server
-        :param type_: If the mail to send is new or a reply
+        :param activity: Browse record of the activity to send
+        :param user: Browse Record of the user sending the mail
+        """
+        failures = cls.send_mails([activity], user)
+        if activity in failures:
+            raise failures[activity]
+        return True
+
+    @classmethod
+    def send_mails(cls, activities, user):
+        """
+        Send the mails of the activities sharing the SMTP sessions of the user
+        server and grouping the writes.
+
+        :return: A dictionary with the exception raised for each activity
+            that could not be sent
         """
         ElectronicMail = Pool().get('electronic.mail')
 
-        if activity.mail:
-            mail = activity.mail
-        else:
-            # Prepare the mail strucuture
-            mime_mail = activity.create_mime_message(user)
-            # Create the mail
-            mail = ElectronicMail.create_from_mail(mime_mail,
-                user.mailbox, activity)
-        if not mail:
-            return
+        recipients, failures = cls.resolve_recipients(activities, user)
+        to_send = [(a, recipients[a].emails) for a in activities
+            if a not in failures]
 
-        # Before to send, control if all mails are corrects
-        # If there are no user in main contact or in contacts, we creat And
-        # activity for internal reason and we send the mail to the employee.
-        emails = []
-        email_to = (activity.contacts and activity.contacts[0].party.email or
-                    activity.employee.party.email)
-        name_to = (activity.contacts and activity.contacts[0].party.name or
-                   activity.employee.party.name)
-        emails_to = ElectronicMail.validate_emails(email_to)
-        if emails_to:
-            emails.append(emails_to)
-        else:
-            raise UserError(gettext(
-                'electronic_mail_activity.no_valid_mail',
-                    mail=email_to, party=name_to))
-        if activity.contacts:
-            for c in activity.contacts:
-                emails_cc = ElectronicMail.validate_emails(c.party.email)
-                if emails_cc:
-                    emails.append(emails_cc)
-                else:
-                    raise UserError(gettext(
-                        'electronic_mail_activity.no_valid_mail',
-                            mail=activity.contacts[0].party.email,
-                            party=activity.contacts[0].party.name))
-        if user and user.smtp_server and user.smtp_server.smtp_email:
-            emails.append(user.smtp_server.smtp_email)
-
-        user.smtp_server.send_mail(mail.from_, list(set(emails)), mail.mail_file)
-        ElectronicMail.write([mail], {
-                'flag_send': True,
-                })
-        cls.write([activity], {
-                'mail': mail.id,
-                })
+        mails, to_link = {}, []
+        with stage('create_mime_message', len(to_send)):
+            for activity, _ in to_send:
+                if activity.mail:
+                    mails[activity] = activity.mail
+                    continue
+                # Prepare the mail strucuture
+                mime_mail = activity.create_mime_message(user,
+                    recipients=recipients[activity])
+                # Create the mail
+                try:
+                    mail = ElectronicMail.create_from_mail(mime_mail,
+                        user.mailbox, activity)
+                except Exception as exception:
+                    failures[activity] = exception
+                    continue
+                if not mail:
+                    failures[activity] = UserError(gettext(
+                            'electronic_mail_activity.mail_not_created',
+                            activity=activity.id))
+                    continue
+                mails[activity] = mail
+                to_link.extend(([activity], {'mail': mail.id}))
+            # Link them at once so a retry does not create them again
+            if to_link:
+                cls.write(*to_link)
+
+        sent = []
+        with stage('send_mail', len(mails)):
+            for activity, emails in to_send:
+                mail = mails.get(activity)
+                if not mail:
+                    continue
+                try:
+                    cls.send_smtp(user.smtp_server, mail.from_, emails,
+                        mail.mail_file)
+                except UserError as exception:
+                    failures[activity] = exception
+                    continue
+                sent.append(activity)
+                logging.getLogger('Activity Mail').info(
+                    'Send email %s from activity %s (to %s)' % (mail.id,
+                        activity.id, emails))
+
+        if sent:
+            ElectronicMail.write([mails[a] for a in sent], {
+                    'flag_send': True,
+                    })
+            cls.write(sent, {
+                    'mail_state': 'sent',
+                    'mail_error': None,
+                    })
+        return failures
 
-        logging.getLogger('Activity Mail').info(
-            'Send email %s from activity %s (to %s)' % (mail.id, activity.id,
-                emails))
+    @classmethod
+    def resolve_recipients(cls, activities, user):
+        """
+        Resolve and validate the recipients of the mails of the activities
+        reading all the parties at once.
 
-        return True
+        :return: A dictionary with the Recipients of each activity and a
+            dictionary with the exception of each activity without a sender,
+            without a recipient or with a not valid email, the emails of their
+            Recipients are None
+        """
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Party = pool.get('party.party')
+
+        party_ids = set()
+        if user.employee:
+            party_ids.add(user.employee.party.id)
+        for activity in activities:
+            if activity.employee:
+                party_ids.add(activity.employee.party.id)
+            party_ids.update(c.party.id for c in activity.contacts)
+        parties = {p['id']: (p['name'], p['email'])
+            for p in Party.read(list(party_ids), ['name', 'email'])}
+
+        validated = {}
+
+        def validate(email):
+            if email not in validated:
+                validated[email] = ElectronicMail.validate_emails(email)
+            return validated[email]
+
+        headers = {}
+
+        def header(name):
+            if name not in headers:
+                headers[name] = _make_header(name)
+            return headers[name]
 
-    def create_mime_message(self, user):
+        bcc = (user and user.smtp_server and user.smtp_server.smtp_email
+            or "")
+        recipients, failures = {}, {}
+        for activity in activities:
+            employee = (activity.employee
+                and parties[activity.employee.party.id])
+            contacts = [parties[c.party.id] for c in activity.contacts]
+
+            if not employee and not contacts:
+                failures[activity] = UserError(gettext(
+                        'electronic_mail_activity.no_recipient',
+                        activity=activity.id))
+                recipients[activity] = Recipients(None, None, None, bcc, None)
+                continue
+            if not employee and not user.employee:
+                failures[activity] = UserError(gettext(
+                        'electronic_mail_activity.no_sender',
+                        activity=activity.id))
+                recipients[activity] = Recipients(None, None, None, bcc, None)
+                continue
+
+            if employee:
+                from_ = formataddr((header(employee[0]), employee[1]))
+            else:
+                from_ = formataddr(parties[user.employee.party.id])
+            if contacts:
+                to = formataddr((header(contacts[0][0]), contacts[0][1]))
+            else:
+                to = formataddr(employee)
+            cc = ",".join(formataddr((header(n), e)) for n, e in contacts)
+
+            # Before to send, control if all mails are corrects
+            # If there are no user in main contact or in contacts, we creat
+            # And activity for internal reason and we send the mail to the
+            # employee.
+            emails = []
+            for name, email in (contacts[:1] or [employee]) + contacts:
+                valid_email = validate(email)
+                if not valid_email:
+                    failures[activity] = UserError(gettext(
+                            'electronic_mail_activity.no_valid_mail',
+                            mail=email, party=name))
+                    emails = None
+                    break
+                emails.append(valid_email)
+            else:
+                if bcc:
+                    emails.append(bcc)
+                emails = list(set(emails))
+            recipients[activity] = Recipients(from_, to, cc, bcc, emails)
+        return recipients, failures
+
+    @classmethod
+    def send_smtp(cls, server, from_, to_addrs, message):
+        "Send the message through a pooled session of the SMTP server"
+        try:
+            with smtp_pool.connection(server_key(server),
+                    server.get_smtp_server) as smtp:
+                smtp.sendmail(from_, to_addrs, message)
+        except (SMTPException, OSError) as exception:
+            raise UserError(gettext('electronic_mail_activity.smtp_error',
+                    server=server.rec_name, error=exception)) from exception
+
+    def create_mime_message(self, user, recipients=None):
         '''Create a MIMEtype structure from activity values
-        :param activity: Object of the activity to send mail
-        :param type_: To know if it's a new mail or a reply
+        :param user: Object of the user sending the mail
+        :param recipients: The Recipients already resolved for the activity
         :return: MIMEtype
         '''
         Attachment = Pool().get('ir.attachment')
 
+        if recipients is None:
+            recipients, _ = self.resolve_recipients([self], user)
+            recipients = recipients[self]
+
         message = MIMEMultipart()
         message['Message-Id'] = self.message_id
         message['Date'] = formatdate(localtime=True)
@@ -278,19 +598,10 @@ class Activity(metaclass=PoolMeta):
             message['In-Reply-To'] = self.in_reply_to
         if self.references:
             message['References'] = self.references
-        message['From'] = (self.employee and formataddr((
-                    _make_header(self.employee.party.name),
-                    self.employee.party.email)) or
-            formataddr((user.employee.party.name, user.employee.party.email)))
-        message['To'] = (self.contacts and formataddr((
-                    _make_header(self.contacts[0].party.name),
-                    self.contacts[0].party.email)) or
-            formataddr((self.employee.party.name, self.employee.party.email)))
-        message['Cc'] = ",".join([
-                formataddr((_make_header(c.party.name), c.party.email))
-                for c in self.contacts])
-        message['Bcc'] = (user and user.smtp_server and
-            user.smtp_server.smtp_email or "")
+        message['From'] = recipients.from_
+        message['To'] = recipients.to
+        message['Cc'] = recipients.cc
+        message['Bcc'] = recipients.bcc
         message['Subject'] = _make_header(self.subject)
 
         content = self.description or ''
@@ -298,7 +609,7 @@ class Activity(metaclass=PoolMeta):
             content += '\n--\n%s' % user.signature
 
         body = MIMEMultipart('alternative')
-        body.attach(MIMEText(html2text(content), 'plain', _charset='utf-8'))
+        body.attach(MIMEText(html_to_text(content), 'plain', _charset='utf-8'))
         body.attach(MIMEText(content, 'html', _charset='utf-8'))
         message.attach(body)
 
@@ -310,11 +621,12 @@ class Activity(metaclass=PoolMeta):
             maintype, subtype = (content_type or 'application/octet-stream'
                 ).split('/', 1)
             part = MIMEBase(maintype, subtype)
-            part.set_payload(attachment.data)
-            encoders.encode_base64(part)
+            # The encoded payload is shared with the cache and written as is
+            # by the generator
+            part.set_payload(base64_payload(attachment))
+            part.add_header('Content-Transfer-Encoding', 'base64')
             part.add_header('Content-Disposition', 'attachment',
                 filename=attachment.name)
-            part.add_header('Content-Transfer-Encoding', 'base64')
             cid = tools.cid_from_attachment(attachment)
             part.add_header('Content-ID', f'<{cid}>')
             message.attach(part)
@@ -326,33 +638,52 @@ class Activity(metaclass=PoolMeta):
                 With the possibility to restic some party list
                 and to search for the non active parties
         """
-        ContactMechanism = Pool().get('party.contact_mechanism')
-        PartyRelation = Pool().get('party.relation')
-        domain = [
-            ('type', '=', 'email'),
-            ('active', '=', active),
-            ('value', '=', email),
-            ]
-        if parties:
-            domain.append(
-                ('party', 'in', parties),
-                )
-        contact_mechanisms = ContactMechanism.search(domain)
-        if contact_mechanisms:
-            if len(contact_mechanisms) == 1:
-                return contact_mechanisms[0]
-            contact_mechanisms_copy = contact_mechanisms[:]
-            for contact_mechanism in contact_mechanisms:
-                party_relation = PartyRelation.search([
-                    ('from_', '=', contact_mechanism.party.id),
-                    ])
-                if party_relation:
-                    contact_mechanisms_copy.remove(contact_mechanism)
-            if not contact_mechanisms_copy or len(contact_mechanisms_copy) > 1:
-                return contact_mechanisms[0]
-            if len(contact_mechanisms_copy) == 1:
-                return contact_mechanisms_copy[0]
-        return None
+        return cls.get_contact_mechanisms(
+            [email], parties=parties, active=active).get(email)
+
+    @classmethod
+    def get_contact_mechanisms(cls, emails, parties=None, active=True):
+        """
+        Return a dictionary with the contact mechanism of each email.
+
+        When several contact mechanisms have the same email, the one of the
+        only party without relations is preferred.
+        """
+        pool = Pool()
+        ContactMechanism = pool.get('party.contact_mechanism')
+        PartyRelation = pool.get('party.relation')
+
+        candidates = defaultdict(list)
+        for sub_emails in grouped_slice(list(set(emails))):
+            domain = [
+                ('type', '=', 'email'),
+                ('active', '=', active),
+                ('value', 'in', list(sub_emails)),
+                ]
+            if parties:
+                domain.append(
+                    ('party', 'in', parties),
+                    )
+            for contact_mechanism in ContactMechanism.search(domain):
+                candidates[contact_mechanism.value].append(contact_mechanism)
+
+        party_ids = {c.party.id for cs in candidates.values() if len(cs) > 1
+            for c in cs}
+        related = set()
+        for sub_ids in grouped_slice(list(party_ids)):
+            related.update(r.from_.id for r in PartyRelation.search([
+                        ('from_', 'in', list(sub_ids)),
+                        ]))
+
+        result = {}
+        for email, contact_mechanisms in candidates.items():
+            unrelated = [c for c in contact_mechanisms
+                if c.party.id not in related]
+            if len(unrelated) == 1:
+                result[email] = unrelated[0]
+            else:
+                result[email] = contact_mechanisms[0]
+        return result
 
     @classmethod
     def create_activity(cls):
@@ -362,121 +693,255 @@ class Activity(metaclass=PoolMeta):
 
         config = ActivityConfiguration(1)
         pending_mailbox = config.pending_mailbox
+        batch_size = config.activity_batch_size
+        batch_count = config.activity_batch_count
 
-        mails = ElectronicMail.search([
-                    ('mailbox', '=', pending_mailbox)
-                    ], order=[('date', 'ASC'), ('id', 'ASC')])
-
+        # The mails are claimed so the next runs skip them while they wait in
+        # a task
+        limit = batch_size * batch_count if batch_count else None
+        mails = ElectronicMail.claim_activity_mails(pending_mailbox, limit)
 
+        # Each batch is a task on its own so it is committed (or rolled back)
+        # independently and several workers can process them in parallel
         with Transaction().set_context(queue_name=QUEUE_NAME):
-            ElectronicMail.__queue__._create_activity(mails)
+            for i in range(0, len(mails), batch_size):
+                batch = mails[i:i + batch_size]
+                task_id, = ElectronicMail.__queue__._create_activity(batch)
+                ElectronicMail.assign_activity_task(batch, task_id)
 
     def get_previous_activity(self):
-        ElectronicMail = Pool().get('electronic.mail')
-        if not isinstance(self.origin, ElectronicMail):
-            return
-        parent = self.origin.parent
-        if not parent:
-            return
-        activities = self.search([
-                ('origin', '=', parent)
-                ], limit=1)
-        if activities:
-            return activities[0]
+        return self.get_previous_activities([self]).get(self.id)
 
     @classmethod
-    def emails_to_check(cls, emails):
+    def get_previous_activities(cls, activities):
+        """Return a dictionary with the closest activity in the thread of the
+        mail origin of each activity"""
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Thread = pool.get('electronic.mail.thread')
+
+        chains = {}
+        for activity in activities:
+            if not isinstance(activity.origin, ElectronicMail):
+                continue
+            mail = activity.origin
+            message_ids = []
+            if mail.in_reply_to:
+                message_ids.extend(mail.in_reply_to.split())
+            if mail.references:
+                message_ids.extend(reversed(mail.references.split()))
+            if message_ids:
+                chains[activity.id] = message_ids
+
+        threads = Thread.get_activities(
+            {m for c in chains.values() for m in c})
+        previous_ids = {}
+        for activity_id, message_ids in chains.items():
+            for message_id in message_ids:
+                previous_id = threads.get(message_id)
+                if previous_id and previous_id != activity_id:
+                    previous_ids[activity_id] = previous_id
+                    break
+        # Browsed together so they share the same cache
+        previous = {a.id: a for a in cls.browse(set(previous_ids.values()))}
+        return {a: previous[p] for a, p in previous_ids.items()}
+
+    @classmethod
+    def internal_emails(cls):
+        "Return the normalized emails of the employees and the companies"
         pool = Pool()
         Employee = pool.get('company.employee')
         Company = pool.get('company.company')
         ContactMechanism = pool.get('party.contact_mechanism')
 
-        employees = Employee.search([])
-        parties = [x.party for x in employees]
-        parties += [x.party for x in Company.search([])]
+        emails = cls._internal_emails_cache.get(None)
+        if emails is not None:
+            return emails
 
-        contact_mechanisms = ContactMechanism.search([
-                ('type', '=', 'email'),
-                ('party', 'in', parties),
-                ('value', '!=', None),
-                ])
+        with without_check_access():
+            employees = Employee.search([])
+            parties = [x.party for x in employees]
+            parties += [x.party for x in Company.search([])]
 
-        mails = [x.value.lower().strip() for x in contact_mechanisms]
+            contact_mechanisms = ContactMechanism.search([
+                    ('type', '=', 'email'),
+                    ('party', 'in', parties),
+                    ('value', '!=', None),
+                    ])
+        emails = frozenset(x.value.lower().strip() for x in contact_mechanisms)
+        cls._internal_emails_cache.set(None, emails)
+        return emails
+
+    @classmethod
+    def emails_to_check(cls, emails):
+        mails = cls.internal_emails()
         return list(set([x for x in emails if x.lower().strip() not in mails]))
 
     def guess_resource(self):
+        self.guess_resources([self])
+
+    @classmethod
+    def guess_resources(cls, activities):
+        """Guess the resource and the party of the activities
+
+        The activities are resolved after the activity of their parent mail
+        when it is in the same list, so the resource of a whole thread can be
+        guessed at once.
+        """
         pool = Pool()
         ElectronicMail = pool.get('electronic.mail')
-        Activity = pool.get('activity.activity')
         Party = pool.get('party.party')
 
-        previous_activity = self.get_previous_activity()
-        if previous_activity:
-            if previous_activity.resource:
-                self.resource = previous_activity.resource
-                if self.resource and hasattr(self.resource, 'party'):
-                    self.party = self.resource.party
-                if not self.party:
-                    self.party = self.on_change_with_party()
-        elif self.origin and isinstance(self.origin, ElectronicMail):
-            addresses = [self.origin.from_, self.origin.to, self.origin.cc]
-            addresses = self.parse_addresses(addresses)
-            addresses = self.emails_to_check(addresses)
-            if not addresses:
-                return
-            email = addresses[0]
-            if not email:
-                return
-
-            activities = Activity.search([
-                ('party', '!=', None),
-                ['OR',
-                    [
-                        ('origin.from_', 'ilike', '%' + email + '%',
-                            'electronic.mail'),
-                    ], [
-                        ('origin.to', 'ilike', '%' + email + '%',
-                            'electronic.mail'),
-                    ],
-                ],
-                ], limit=1, order=[('dtstart', 'DESC')])
-            if activities:
-                self.party = activities[0].party
-                return
-
-            parties = Party.search([
-                ('contact_mechanisms.value', 'ilike', email),
-                ], limit=1)
-            if parties:
-                self.party = parties[0]
+        batch = {a.id: a for a in activities}
+        previous_activities = cls.get_previous_activities(activities)
+
+        ordered, seen = [], set()
+        for activity in activities:
+            chain = []
+            while activity and activity.id not in seen:
+                seen.add(activity.id)
+                chain.append(activity)
+                previous = previous_activities.get(activity.id)
+                activity = previous and batch.get(previous.id)
+            ordered.extend(reversed(chain))
+
+        to_lookup = {}
+        for activity in ordered:
+            previous_activity = previous_activities.get(activity.id)
+            if previous_activity:
+                previous_activity = batch.get(
+                    previous_activity.id, previous_activity)
+                if previous_activity.resource:
+                    activity.resource = previous_activity.resource
+                    if activity.resource and hasattr(
+                            activity.resource, 'party'):
+                        activity.party = activity.resource.party
+                    if not activity.party:
+                        activity.party = activity.on_change_with_party()
+            elif activity.origin and isinstance(
+                    activity.origin, ElectronicMail):
+                addresses = [activity.origin.from_, activity.origin.to,
+                    activity.origin.cc]
+                addresses = cls.parse_addresses(addresses)
+                addresses = cls.emails_to_check(addresses)
+                if addresses and addresses[0]:
+                    to_lookup[activity] = addresses[0]
+        if not to_lookup:
+            return
+
+        emails = set(to_lookup.values())
+        last_activities = cls._get_last_mail_activities(emails)
+        contact_parties = cls.get_parties_from_contact_mechanisms(
+            emails - set(last_activities))
+
+        # The activities of the list take part in the lookup of the next ones
+        # as if they were saved one by one
+        def key(activity):
+            return (activity.dtstart or datetime.min, activity.id)
+        guessed = defaultdict(list)
+        for position, activity in enumerate(ordered):
+            email = to_lookup.get(activity)
+            if email:
+                candidates = [a for p, a in guessed[email] if p < position]
+                if email in last_activities:
+                    candidates.append(last_activities[email])
+                if candidates:
+                    activity.party = max(candidates, key=key).party
+                elif email in contact_parties:
+                    activity.party = Party(contact_parties[email])
+            if (activity.party
+                    and isinstance(activity.origin, ElectronicMail)):
+                for address in set(cls.parse_addresses([
+                                activity.origin.from_,
+                                activity.origin.to])):
+                    guessed[address].append((position, activity))
+
+    @classmethod
+    def _get_last_mail_activities(cls, emails):
+        """Return a dictionary with the last activity with party from a mail
+        sent from or to each email"""
+        pool = Pool()
+        MailAddress = pool.get('electronic.mail.address')
+        activity = cls.__table__()
+        address = MailAddress.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {}
+        for sub_emails in grouped_slice(emails):
+            query = address.join(activity,
+                condition=activity.origin == Concat(
+                    'electronic.mail,', address.mail)
+                ).select(
+                    address.address,
+                    activity.id,
+                    RowNumber(window=Window([address.address],
+                            order_by=[activity.dtstart.desc,
+                                activity.id.desc])).as_('rank'),
+                    where=address.address.in_(list(sub_emails))
+                    & address.type.in_(['from', 'to'])
+                    & (activity.party != Null))
+            cursor.execute(*query.select(query.address, query.id,
+                    where=query.rank == 1))
+            result.update(cursor)
+        activities = cls.browse(result.values())
+        return {e: a for e, a in zip(result.keys(), activities)}
+
+    @classmethod
+    def get_parties_from_contact_mechanisms(cls, emails):
+        """Return a dictionary with the party of a contact mechanism of each
+        email"""
+        ContactMechanism = Pool().get('party.contact_mechanism')
+
+        result = {}
+        for sub_emails in grouped_slice(emails):
+            contact_mechanisms = ContactMechanism.search([
+                    ('normalized_email', 'in', list(sub_emails)),
+                    ('party.active', '=', True),
+                    ], order=[('party', 'ASC'), ('id', 'ASC')])
+            for contact_mechanism in contact_mechanisms:
+                result.setdefault(contact_mechanism.normalized_email,
+                    contact_mechanism.party.id)
+        return result
 
     def guess_contacts(self):
+        self.guess_activities_contacts([self])
+
+    @classmethod
+    def guess_activities_contacts(cls, activities):
+        """Add to the activities the allowed contacts found in their mail
+
+        The existing contacts of all the activities are read at once and
+        the emails are matched with a dictionary of the allowed contacts.
+        """
         pool = Pool()
         ElectronicMail = pool.get('electronic.mail')
         ActivityParty = pool.get('activity.activity-party.party')
 
-        if isinstance(self.origin, ElectronicMail):
-            addresses = [self.origin.from_, self.origin.to, self.origin.cc]
-            addresses = self.parse_addresses(addresses)
-            emails = self.emails_to_check(addresses)
+        activities = [a for a in activities
+            if isinstance(a.origin, ElectronicMail) and a.contacts]
+        existing = set()
+        activity_ids = [a.id for a in activities if a.id is not None]
+        for sub_ids in grouped_slice(activity_ids):
+            existing.update((c.activity.id, c.party.id)
+                for c in ActivityParty.search([
+                        ('activity', 'in', list(sub_ids)),
+                        ]))
+
+        for activity in activities:
+            mail = activity.origin
+            addresses = cls.parse_addresses([mail.from_, mail.to, mail.cc])
+            emails = cls.emails_to_check(addresses)
+            parties = {}
+            for party in activity.contacts[0].allowed_contacts:
+                if party.email:
+                    parties.setdefault(party.email.strip().lower(), party)
             to_add = []
-            if not self.contacts:
-                return to_add
-            for party in self.contacts[0].allowed_contacts:
-                for x in emails:
-                    if x == party.email.strip().lower():
-                        activity_contact = ActivityParty.search([
-                            ('activity', '=', self.id),
-                            ('party', '=', party.id),
-                            ], limit=1)
-                        if not activity_contact:
-                            activity_contact = ActivityParty()
-                            activity_contact.activity = self
-                            activity_contact.party = party
-                        else:
-                            activity_contact = activity_contact[0]
-                        to_add.append(activity_contact)
-            self.contacts += tuple(set(to_add))
+            for party in {parties[e] for e in emails if e in parties}:
+                if (activity.id, party.id) in existing:
+                    continue
+                to_add.append(ActivityParty(activity=activity, party=party))
+            if to_add:
+                activity.contacts += tuple(to_add)
 
     @classmethod
     def parse_addresses(cls, addresses):
@@ -485,11 +950,103 @@ class Activity(metaclass=PoolMeta):
 
     @classmethod
     def send_mail_auto(cls, activities):
-        User = Pool().get('res.user')
-        user = User(Transaction().user)
-        for activity in activities:
-            if activity.activity_type.send_mail_automatically:
-                cls.send_mail(activity, user)
+        cls.queue_mails([a for a in activities
+                if a.activity_type
+                and a.activity_type.send_mail_automatically])
+
+    @classmethod
+    def queue_mails(cls, activities):
+        "Send the mails of the activities in a task once the transaction ends"
+        if not activities:
+            return
+        cls.write(list(activities), {
+                'mail_state': 'queued',
+                'mail_attempts': 0,
+                'mail_error': None,
+                })
+        with Transaction().set_context(queue_name=QUEUE_NAME):
+            cls.__queue__.send_queued_mails(activities)
+
+    @classmethod
+    def send_queued_mails(cls, activities):
+        activities = [a for a in activities if a.mail_state == 'queued']
+        if not activities:
+            return
+
+        failed = []
+        try:
+            user = cls.check_activity_user_info()
+        except UserError as exception:
+            failed = [(a, exception) for a in activities]
+        else:
+            failed = list(cls.send_mails(activities, user).items())
+
+        retries = defaultdict(list)
+        for activity, exception in failed:
+            attempts = (activity.mail_attempts or 0) + 1
+            activity.mail_attempts = attempts
+            activity.mail_error = str(exception)
+            if attempts < SEND_RETRIES:
+                retries[SEND_RETRY_DELAY * 2 ** (attempts - 1)].append(
+                    activity)
+            else:
+                activity.mail_state = 'failed'
+            logging.getLogger('Activity Mail').warning(
+                'Send email from activity %s failed (attempt %s): %s' % (
+                    activity.id, attempts, exception))
+        cls.save([a for a, _ in failed])
+
+        for delay, to_retry in retries.items():
+            with Transaction().set_context(
+                    queue_name=QUEUE_NAME,
+                    queue_scheduled_at=timedelta(seconds=delay)):
+                cls.__queue__.send_queued_mails(to_retry)
+
+
+class InternalEmailsMixin(object):
+    "Clear the cache of the internal emails when the records change"
+    __slots__ = ()
+
+    @classmethod
+    def _clear_internal_emails(cls):
+        Activity = Pool().get('activity.activity')
+        Activity._internal_emails_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        cls._clear_internal_emails()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._clear_internal_emails()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        cls._clear_internal_emails()
+
+
+def quote_description(description, depth=None):
+    """Return the description quoted for a reply
+
+    The lines already quoted depth times are dropped so the reply keeps at
+    most depth quote levels.
+    """
+    if not description:
+        return description
+
+    def lines():
+        for line in description.split('\n'):
+            line = line.strip()
+            if depth:
+                prefix = QUOTE_PREFIX.match(line).group()
+                if prefix.count('>') >= depth:
+                    continue
+            yield "> %s" % line
+    return '\n'.join(lines())
 
 
 class ActivityReplyMail(Wizard, metaclass=PoolMeta):
@@ -499,24 +1056,34 @@ class ActivityReplyMail(Wizard, metaclass=PoolMeta):
     open_ = StateAction('activity.act_activity_activity')
 
     def do_open_(self, action):
-        Activity = Pool().get('activity.activity')
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        Configuration = pool.get('activity.configuration')
 
+        depth = Configuration(1).get_reply_quote_depth()
         re = "Re: "
-        return_activities = []
-        for activity in self.records:
-            return_activity = Activity.copy([activity])[0]
-            if return_activity.subject[:3].lower() != re[:3].lower():
-                return_activity.subject = "%s%s" % (re, return_activity.subject)
-            return_activity.direction = 'outgoing'
-            return_activity.dtstart = datetime.now()
-            return_activity.mail = None
-            return_activity.description = '\n'.join("> %s" % l.strip()
-                for l in return_activity.description.split('\n'))
-            return_activity.related_activity = activity.id
-            return_activity.save()
-            return_activities.append(return_activity.id)
-
-        data = {'res_id': return_activities}
+
+        def subject(data):
+            subject = data['subject'] or ''
+            if subject[:3].lower() != re[:3].lower():
+                subject = "%s%s" % (re, subject)
+            return subject
+
+        descriptions = {a.id: a.full_description for a in self.records}
+
+        def description(data):
+            return quote_description(descriptions[data['id']], depth)
+
+        return_activities = Activity.copy(self.records, default={
+                'subject': subject,
+                'direction': 'outgoing',
+                'dtstart': datetime.now(),
+                'mail': None,
+                'description': description,
+                'related_activity': lambda data: data['id'],
+                })
+
+        data = {'res_id': [a.id for a in return_activities]}
         if len(return_activities) == 1:
             action['views'].reverse()
         return action, data
@@ -567,47 +1134,27 @@ class SendActivityMailMixin():
         pool = Pool()
         Activity = pool.get('activity.activity')
         User = pool.get('res.user')
-        Party = pool.get('party.party')
         ActivityParty = pool.get('activity.activity-party.party')
-        activity = Activity()
+
+        employee = None
         activities_to_save = []
         actions = iter(args)
+        args = []
         for records, values in zip(actions, actions):
+            if not any(values.get(f) for f in [
+                        'activity_type', 'activity_state',
+                        'activity_contact', 'activity_work_time']):
+                args.extend((records, values))
+                continue
+
+            if employee is None:
+                employee = User(Transaction().user).employee
+
+            dtstart = values.get('activity_date') or datetime.now()
+            dttime = Activity.utc_to_local(dtstart)
+            contact = values.get('activity_contact')
             for record in records:
-                create_activity = False
-                for field in ['activity_type', 'activity_state',
-                        'activity_contact', 'activity_work_time']:
-                    if values.get(field):
-                        create_activity = True
-                        break
-                if not create_activity:
-                    continue
-
-                user = User(Transaction().user)
-                employee = user.employee
-
-                subject = None
-                if values.get('activity_subject'):
-                    subject = values.get('activity_subject')
-
-                dtstart = datetime.now()
-                dttime = Activity.utc_to_local(dtstart)
-                if values.get('activity_date'):
-                    dtstart = values.get('activity_date')
-                    dttime = Activity.utc_to_local(dtstart)
-
-                parties = []
-                contacts = []
-                if 'activity_contact' in values:
-                    parties = Party.search([('id', '=',
-                        values['activity_contact']
-                        if values['activity_contact'] else None)])
-                for party in parties:
-                    activity_contact = ActivityParty()
-                    activity_contact.activity = activity
-                    activity_contact.party = party
-                    contacts.append(activity_contact)
-
+                activity = Activity()
                 activity.description = values.get('activity_text') or ''
                 activity.activity_type = values.get('activity_type')
                 activity.resource = record
@@ -616,46 +1163,26 @@ class SendActivityMailMixin():
                 activity.date = dtstart.date()
                 activity.time = dttime.time()
                 activity.party = record.party
-                activity.contacts = tuple(set(contacts))
-                activity.subject = subject
+                activity.contacts = []
+                if contact:
+                    activity.contacts = [
+                        ActivityParty(activity=activity, party=contact)]
+                activity.subject = values.get('activity_subject')
                 activity.duration = values.get('activity_work_time')
                 activities_to_save.append(activity)
 
-                values['activity_text'] = None
-                values['activity_type'] = None
-                values['activity_contact'] = None
-                values['activity_state'] = None
-                values['activity_work_time'] = None
-                values['activity_subject'] = None
-                values['activity_date'] = None
+            values = values.copy()
+            values['activity_text'] = None
+            values['activity_type'] = None
+            values['activity_contact'] = None
+            values['activity_state'] = None
+            values['activity_work_time'] = None
+            values['activity_subject'] = None
+            values['activity_date'] = None
+            args.extend((records, values))
 
         super().write(*args)
         if activities_to_save:
-            for activity in activities_to_save:
-                resource = activity.resource
-                if hasattr(resource, 'contacts'):
-                    if resource.contacts:
-                        activity_contacts = []
-                        for contact in contacts:
-                            if isinstance(contact, Party):
-                                party = contact
-                            elif hasattr(contact, 'party'):
-                                party = contact.party
-                            else:
-                                continue
-                            found_contacts = ActivityParty.search([
-                                ('activity', '=', activity.id),
-                                ('party', '=', party.id),
-                                ], limit=1)
-                            if found_contacts:
-                                if found_contacts[0] not in activity.contacts:
-                                    activity_contacts.append(found_contacts[0])
-                            else:
-                                activity_contact = ActivityParty()
-                                activity_contact.activity = activity
-                                activity_contact.party = party
-                                activity_contacts.append(activity_contact)
-                        activity.contacts += tuple(activity_contacts)
             Activity.save(activities_to_save)
             Activity.send_mail_auto(activities_to_save)
 
@@ -0,0 +1,139 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import hashlib
+
+from sql import Literal, Null
+from sql.aggregate import Count, Max, Sum
+
+from trytond.model import fields, Index
+from trytond.pool import PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+
+class Attachment(metaclass=PoolMeta):
+    __name__ = 'ir.attachment'
+
+    content_hash = fields.Char('Content Hash', readonly=True)
+    content_size = fields.Integer('Content Size', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.content_hash, Index.Equality())))
+
+    @staticmethod
+    def _content_values(data):
+        if data is None:
+            return {
+                'content_hash': None,
+                'content_size': None,
+                }
+        return {
+            'content_hash': hashlib.sha256(data).hexdigest(),
+            'content_size': len(data),
+            }
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            if 'data' in values and 'content_hash' not in values:
+                values.update(cls._content_values(values['data']))
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for records, values in zip(actions, actions):
+            if 'data' in values:
+                values = values.copy()
+                values.update(cls._content_values(values['data']))
+            args.extend((records, values))
+        super().write(*args)
+
+    @classmethod
+    def copy(cls, attachments, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('content_hash')
+        default.setdefault('content_size')
+        return super().copy(attachments, default=default)
+
+    @classmethod
+    def get_content_file_ids(cls, hashes):
+        "Return a dictionary with the file id already stored for each hash"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        file_ids = {}
+        if not cls.data.file_id:
+            return file_ids
+        for sub_hashes in grouped_slice(list(hashes)):
+            cursor.execute(*table.select(
+                    table.content_hash, Max(table.file_id),
+                    where=table.content_hash.in_(list(sub_hashes))
+                    & (table.file_id != Null),
+                    group_by=[table.content_hash]))
+            file_ids.update(cursor)
+        return file_ids
+
+    @classmethod
+    def create_deduplicated(cls, vlist):
+        """Create attachments writing only once the data of identical contents
+
+        The attachments with a content already stored share its file instead
+        of writing the same data again.
+        """
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            if values.get('data') is not None:
+                values.update(cls._content_values(values['data']))
+        if not cls.data.file_id:
+            return cls.create(vlist)
+
+        file_ids = cls.get_content_file_ids(
+            {v['content_hash'] for v in vlist if v.get('content_hash')})
+
+        to_create, duplicates = [], []
+        for values in vlist:
+            content_hash = values.get('content_hash')
+            if content_hash and content_hash in file_ids:
+                duplicates.append(values)
+            else:
+                to_create.append(values)
+                if content_hash:
+                    # The next ones with the same content share its file
+                    file_ids[content_hash] = None
+        attachments = cls.create(to_create)
+
+        if duplicates:
+            file_ids.update(cls.get_content_file_ids(
+                    {h for h, f in file_ids.items() if f is None}))
+            for values in duplicates:
+                values['file_id'] = file_ids[values['content_hash']]
+                del values['data']
+            attachments += cls.create(duplicates)
+        return attachments
+
+    @classmethod
+    def get_deduplication(cls):
+        """Return the number of attachments sharing the file of another one and
+        the size saved by not storing them again"""
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        files = table.select(
+            Count(Literal('*')).as_('count'),
+            Max(table.content_size).as_('size'),
+            where=(table.content_hash != Null) & (table.file_id != Null),
+            group_by=[table.file_id])
+        cursor.execute(*files.select(
+                Sum(files.count - 1),
+                Sum((files.count - 1) * files.size)))
+        count, size = cursor.fetchone()
+        return count or 0, size or 0
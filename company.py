@@ -0,0 +1,13 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+from .activity import InternalEmailsMixin
+
+
+class Company(InternalEmailsMixin, metaclass=PoolMeta):
+    __name__ = 'company.company'
+
+
+class Employee(InternalEmailsMixin, metaclass=PoolMeta):
+    __name__ = 'company.employee'
@@ -1,5 +1,7 @@
-from trytond.pool import PoolMeta
-from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.model import ModelView, fields
+from trytond.pyson import Bool, Eval
+from trytond.wizard import Button, StateView, Wizard
 
 
 class Configuration(metaclass=PoolMeta):
@@ -11,3 +13,83 @@ class Configuration(metaclass=PoolMeta):
             required=True)
     processed_mailbox = fields.Many2One('electronic.mail.mailbox', 'Processed Mailbox',
             required=True)
+    activity_batch_size = fields.Integer('Activity Batch Size', required=True,
+        domain=[('activity_batch_size', '>', 0)],
+        help='The number of pending mails processed by each queue task.')
+    activity_batch_count = fields.Integer('Activity Batch Count',
+        domain=['OR',
+            ('activity_batch_count', '=', None),
+            ('activity_batch_count', '>', 0),
+            ],
+        help='The maximum number of queue tasks created on each run.\n'
+        'Leave empty to enqueue all the pending mails.')
+    reply_quote_depth = fields.Integer('Reply Quote Depth',
+        domain=['OR',
+            ('reply_quote_depth', '=', None),
+            ('reply_quote_depth', '>', 0),
+            ],
+        states={
+            'invisible': Bool(Eval('reply_quote_latest')),
+            },
+        help='The maximum number of quote levels kept in the replies.\n'
+        'Leave empty to quote the whole thread.')
+    reply_quote_latest = fields.Boolean('Quote Only Latest Message',
+        help='Quote only the message replied and not the thread it quotes.')
+    mail_body_reference = fields.Boolean('Reference Mail Body',
+        help='Store only an excerpt of the body of the mails as description '
+        'of their activities.\nThe whole body is read from the mail.')
+    mail_body_excerpt_size = fields.Integer('Mail Body Excerpt Size',
+        domain=['OR',
+            ('mail_body_excerpt_size', '=', None),
+            ('mail_body_excerpt_size', '>=', 0),
+            ],
+        states={
+            'invisible': ~Eval('mail_body_reference'),
+            },
+        help='The number of characters of the body stored as description.')
+
+    @staticmethod
+    def default_activity_batch_size():
+        return 100
+
+    @staticmethod
+    def default_mail_body_excerpt_size():
+        return 200
+
+    def get_reply_quote_depth(self):
+        "Return the maximum quote levels of the replies or None for no limit"
+        if self.reply_quote_latest:
+            return 1
+        return self.reply_quote_depth
+
+
+class AttachmentDeduplicationStart(ModelView):
+    'Attachment Deduplication'
+    __name__ = 'activity.attachment.deduplication.start'
+
+    deduplicated = fields.Integer('Deduplicated Attachments', readonly=True,
+        help='The number of attachments sharing the stored file of an '
+        'identical one.')
+    saved_size = fields.Integer('Saved Size', readonly=True,
+        help='The bytes not stored thanks to the deduplication of the '
+        'attachments.')
+
+
+class AttachmentDeduplication(Wizard):
+    'Attachment Deduplication'
+    __name__ = 'activity.attachment.deduplication'
+    start = StateView('activity.attachment.deduplication.start',
+        'electronic_mail_activity.attachment_deduplication_start_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_start(self, fields):
+        Attachment = Pool().get('ir.attachment')
+
+        # The whole attachment table is aggregated so it is only computed
+        # on demand
+        count, size = Attachment.get_deduplication()
+        return {
+            'deduplicated': count,
+            'saved_size': size,
+            }
@@ -1,15 +1,256 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from email import message_from_bytes
+from datetime import datetime, timedelta
+from sql import Literal, Null
+from sql.aggregate import Min
+from sql.functions import CurrentTimestamp
+from trytond import backend
 from trytond.config import config
+from trytond.model import ModelSQL, fields, Index
 from trytond.pool import Pool, PoolMeta
-from html2text import html2text
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 
-QUEUE_NAME = config.get('electronic_mail', 'queue_name', default='default')
+from .mime import mime_cache, parse_mails
+from .statistic import stage
+
+CLAIM_TIMEOUT = config.getint('electronic_mail', 'activity_claim_timeout',
+    default=60 * 60)
+ATTACHMENT_FLUSH_SIZE = config.getint('electronic_mail',
+    'activity_attachment_flush_size', default=8 * 1024 * 1024)
+
+
+def excerpt(text, size):
+    "Return the first size characters of the text"
+    if not size:
+        return None
+    if len(text) <= size:
+        return text
+    return text[:size].rstrip() + '...'
 
 
 class ElectronicMail(metaclass=PoolMeta):
     __name__ = 'electronic.mail'
+    activity_claimed_at = fields.Timestamp("Activity Claimed At",
+        readonly=True,
+        help="When the mail was claimed by a task creating its activity.")
+    activity_claim_task = fields.Many2One('ir.queue', "Activity Claim Task",
+        readonly=True, ondelete='SET NULL',
+        help="The task creating the activity of the mail.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.mailbox, Index.Equality()),
+                (t.date, Index.Range(order='ASC')),
+                (t.id, Index.Range(order='ASC'))))
+
+    @classmethod
+    def create(cls, vlist):
+        MailAddress = Pool().get('electronic.mail.address')
+        mails = super().create(vlist)
+        MailAddress.update_mails(mails)
+        return mails
+
+    @classmethod
+    def write(cls, *args):
+        MailAddress = Pool().get('electronic.mail.address')
+        super().write(*args)
+        actions = iter(args)
+        to_update = []
+        for mails, values in zip(actions, actions):
+            if values.keys() & set(MailAddress._mail_fields.values()):
+                to_update.extend(mails)
+        if to_update:
+            MailAddress.update_mails(to_update)
+
+    @classmethod
+    def copy(cls, mails, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('activity_claimed_at')
+        default.setdefault('activity_claim_task')
+        return super().copy(mails, default=default)
+
+    @classmethod
+    def claim_activity_mails(cls, mailbox, limit=None):
+        """Claim the oldest mails of the mailbox not claimed by another task
+
+        The claim lasts as long as the task is waiting in the queue. The
+        tasks started more than CLAIM_TIMEOUT seconds ago without finishing
+        are considered lost and their mails are claimed again.
+        """
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        transaction = Transaction()
+        database = transaction.database
+        table = cls.__table__()
+        queue = Queue.__table__()
+        cursor = transaction.connection.cursor()
+
+        now = datetime.now()
+        stale = now - timedelta(seconds=CLAIM_TIMEOUT)
+        running = queue.select(queue.id,
+            where=(queue.finished_at == Null)
+            & ((queue.dequeued_at == Null) | (queue.dequeued_at >= stale)))
+        query = table.select(table.id,
+            where=(table.mailbox == mailbox.id)
+            & ((table.activity_claim_task == Null)
+                | ~table.activity_claim_task.in_(running)),
+            order_by=[table.date.asc, table.id.asc],
+            limit=limit)
+        if database.has_select_for():
+            # Concurrent claims get disjoint mails
+            For = database.get_select_for_skip_locked()
+            query.for_ = For('UPDATE')
+        cursor.execute(*query)
+        mail_ids = [i for i, in cursor]
+        for sub_ids in grouped_slice(mail_ids):
+            cursor.execute(*table.update(
+                    [table.activity_claimed_at], [now],
+                    where=reduce_ids(table.id, sub_ids)))
+        return cls.browse(mail_ids)
+
+    @classmethod
+    def assign_activity_task(cls, mails, task_id):
+        "Link the claim of the mails to the task creating their activity"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_ids in grouped_slice([m.id for m in mails]):
+            cursor.execute(*table.update(
+                    [table.activity_claim_task], [task_id],
+                    where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def lock_activity_mails(cls, mails):
+        """Lock the mails for the transaction and return them
+
+        The mails locked by another transaction are skipped.
+        """
+        transaction = Transaction()
+        database = transaction.database
+        if not database.has_select_for():
+            return list(mails)
+        For = database.get_select_for_skip_locked()
+        table = cls.__table__()
+        cursor = transaction.connection.cursor()
+
+        locked = set()
+        for sub_ids in grouped_slice([m.id for m in mails]):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.id, sub_ids),
+                    for_=For('UPDATE')))
+            locked.update(i for i, in cursor)
+        return [m for m in mails if m.id in locked]
+
+    @classmethod
+    def release_activity_mails(cls, mails):
+        "Release the claim of the mails"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_ids in grouped_slice([m.id for m in mails]):
+            cursor.execute(*table.update(
+                    [table.activity_claimed_at, table.activity_claim_task],
+                    [Null, Null],
+                    where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def _mails_with_activity(cls, mails):
+        "Return the set of ids of the mails already linked to an activity"
+        Activity = Pool().get('activity.activity')
+        activity = Activity.__table__()
+        cursor = Transaction().connection.cursor()
+
+        mail_ids = set()
+        for sub_ids in grouped_slice([m.id for m in mails]):
+            cursor.execute(*activity.select(activity.mail,
+                    where=reduce_ids(activity.mail, sub_ids)))
+            mail_ids.update(m for m, in cursor)
+        return mail_ids
+
+    @classmethod
+    def _save_activities(cls, activities):
+        """Save the activities and store the attachments of their mails
+
+        activities is a list of activity and attachments, the attachments
+        being a list of filename and data. Identical contents share the same
+        stored file.
+        """
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        Attachment = pool.get('ir.attachment')
+
+        Activity.save([a for a, _ in activities])
+        to_save = []
+        for activity, attachments in activities:
+            for filename, data in attachments:
+                filename = (filename or activity.subject or '').replace(
+                    '\n', '').replace('\r', '')
+                to_save.append({
+                        'name': filename,
+                        'type': 'data',
+                        'data': data,
+                        'resource': str(activity),
+                        })
+        if to_save:
+            Attachment.create_deduplicated(to_save)
+
+    @classmethod
+    def get_activity_descriptions(cls, mails):
+        "Return a dictionary with the description rendered for each mail"
+        database = Transaction().database.name
+        result, to_parse = {}, []
+        for mail in mails:
+            description = mime_cache.get(('description', database, mail.id))
+            if description is not None:
+                result[mail.id] = description
+            else:
+                to_parse.append(mail)
+        parsed = parse_mails(cls._iter_mail_files(to_parse),
+            attachments=False)
+        for mail, (description, _) in zip(to_parse, parsed):
+            description = description or ''
+            mime_cache.set(('description', database, mail.id), description)
+            result[mail.id] = description
+        return result
+
+    @classmethod
+    def _iter_mail_files(cls, mails):
+        """Yield the raw file of each mail
+
+        The files are read without keeping them in the cache, by groups of
+        mails totalling ATTACHMENT_FLUSH_SIZE bytes.
+        """
+        ids = [m.id for m in mails]
+        if 'size' in cls._fields:
+            sizes = {r['id']: r['size'] or 0
+                for r in cls.read(ids, ['size'])}
+        else:
+            # Without the size each file is read on its own
+            sizes = dict.fromkeys(ids, ATTACHMENT_FLUSH_SIZE)
+
+        def read(group):
+            files = {r['id']: r['mail_file']
+                for r in cls.read(group, ['mail_file'])}
+            for mail_id in group:
+                yield files.pop(mail_id)
+
+        group, size = [], 0
+        for mail_id in ids:
+            group.append(mail_id)
+            size += sizes[mail_id]
+            if size >= ATTACHMENT_FLUSH_SIZE:
+                yield from read(group)
+                group, size = [], 0
+        if group:
+            yield from read(group)
 
     @classmethod
     def _create_activity(cls, mails):
@@ -18,61 +259,246 @@ class ElectronicMail(metaclass=PoolMeta):
         Activity = pool.get('activity.activity')
         ActivityType = pool.get('activity.type')
         ActivityConfiguration = pool.get('activity.configuration')
-        Attachment = pool.get('ir.attachment')
 
         config = ActivityConfiguration(1)
         employee = config.employee
         processed_mailbox = config.processed_mailbox
+        reference_body = config.mail_body_reference
+        excerpt_size = config.mail_body_excerpt_size or 0
 
         activity_type = ActivityType(ModelData.get_id('activity',
                 'incoming_email_type'))
 
-        activities = []
-        activity_attachments = []
-        for mail in mails:
-            exist = Activity.search([('mail', '=', mail.id)])
-            if exist:
-                continue
-            if mail.mailbox == processed_mailbox:
-                continue
-            activity = Activity()
-            if mail.subject:
-                activity.subject = mail.subject.replace('\r', '')
-            activity.activity_type = activity_type
-            activity.employee = employee
-            activity.dtstart = mail.date
-            if mail.body_plain:
-                activity.description = mail.body_plain
-            elif mail.body_html:
-                activity.description = html2text(str(mail.body_html))
-            activity.mail = mail
-            activity.state = 'planned'
-
-            activity.resource = None
-            activity.origin = mail
-
-            if mail.mail_file:
-                msg = message_from_bytes(mail.mail_file)
-                attachments = []
-                for attachment in cls.get_attachments(msg):
-                    attachments.append(Attachment(
-                        name = attachment.get('filename', mail.subject),
-                        type = 'data',
-                        data = attachment.get('data')))
-                activity_attachments.append(attachments)
-            activities.append(activity)
-
-        if activities:
-            Activity.save(activities)
-            to_save = []
-            for activity, attachments in zip(activities, activity_attachments):
-                for attachment in attachments:
-                    attachment.name = attachment.name.replace(
-                        '\n','').replace('\r', '')
-                    attachment.resource = str(activity)
-                to_save += attachments
-            Attachment.save(to_save)
-            Activity.guess(activities)
-
-        # mails to processed mailbox
-        cls.write(mails, {'mailbox': processed_mailbox})
+        with stage('create_activity', len(mails)):
+            # The mails being processed by another worker are left to it
+            claimed = mails = cls.lock_activity_mails(mails)
+
+            # Mails already processed are discarded on the database and the
+            # ones with an activity are fetched at once and kept for the whole
+            # batch
+            mails = cls.search([
+                    ('id', 'in', [m.id for m in mails]),
+                    ('mailbox', '!=', processed_mailbox),
+                    ], order=[('date', 'ASC'), ('id', 'ASC')])
+            with_activity = cls._mails_with_activity(mails)
+
+            new_mails = []
+            for mail in mails:
+                if mail.id not in with_activity:
+                    with_activity.add(mail.id)
+                    new_mails.append(mail)
+
+            # The parsing may run in other processes while the activities
+            # are saved in sub-batches of ATTACHMENT_FLUSH_SIZE bytes of
+            # attachments. A mail is always parsed and saved whole so the
+            # memory is bounded per mail and not per attachment.
+            activities, to_save, size = [], [], 0
+            parsed = parse_mails(cls._iter_mail_files(new_mails))
+            for mail, (description, attachments) in zip(new_mails, parsed):
+                activity = Activity()
+                if mail.subject:
+                    activity.subject = mail.subject.replace('\r', '')
+                activity.activity_type = activity_type
+                activity.employee = employee
+                activity.dtstart = mail.date
+                if description and reference_body:
+                    activity.description = excerpt(description, excerpt_size)
+                    activity.mail_body_referenced = True
+                elif description:
+                    activity.description = description
+                activity.mail = mail
+                activity.state = 'planned'
+
+                activity.resource = None
+                activity.origin = mail
+                activities.append(activity)
+                to_save.append((activity, attachments))
+                size += sum(len(d) for _, d in attachments)
+                if size >= ATTACHMENT_FLUSH_SIZE:
+                    cls._save_activities(to_save)
+                    to_save, size = [], 0
+            if to_save:
+                cls._save_activities(to_save)
+            del to_save
+
+            if activities:
+                Activity.guess(activities)
+
+            # mails to processed mailbox
+            cls.write(mails, {'mailbox': processed_mailbox})
+            cls.release_activity_mails(claimed)
+
+
+class ElectronicMailAddress(ModelSQL):
+    "Electronic Mail Address"
+    __name__ = 'electronic.mail.address'
+    mail = fields.Many2One('electronic.mail', "Mail", required=True,
+        ondelete='CASCADE')
+    type = fields.Selection([
+            ('from', "From"),
+            ('to', "To"),
+            ('cc', "Cc"),
+            ], "Type", required=True)
+    address = fields.Char("Address", required=True,
+        help="The parsed and lower-cased address.")
+
+    _mail_fields = {
+        'from': 'from_',
+        'to': 'to',
+        'cc': 'cc',
+        }
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.address, Index.Equality()),
+                    (t.type, Index.Equality())),
+                Index(t, (t.mail, Index.Equality())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        super().__register__(module_name)
+
+        if not exist:
+            cls._index_existing_mails()
+
+    @classmethod
+    def _index_existing_mails(cls):
+        ElectronicMail = Pool().get('electronic.mail')
+        mail = ElectronicMail.__table__()
+        cursor = Transaction().connection.cursor()
+
+        columns = [mail.id] + [
+            getattr(mail, f) for f in cls._mail_fields.values()]
+        last_id = 0
+        while True:
+            cursor.execute(*mail.select(*columns,
+                    where=mail.id > last_id,
+                    order_by=[mail.id.asc],
+                    limit=1000))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            cls._insert_addresses(rows)
+            last_id = rows[-1][0]
+
+    @classmethod
+    def update_mails(cls, mails):
+        "Index the addresses of the mails"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_mails in grouped_slice(mails):
+            sub_mails = list(sub_mails)
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.mail, [m.id for m in sub_mails])))
+            cls._insert_addresses([
+                    [m.id] + [getattr(m, f) for f in cls._mail_fields.values()]
+                    for m in sub_mails])
+
+    @classmethod
+    def _insert_addresses(cls, rows):
+        Activity = Pool().get('activity.activity')
+        transaction = Transaction()
+        table = cls.__table__()
+        cursor = transaction.connection.cursor()
+
+        values = []
+        for row in rows:
+            mail_id = row[0]
+            for type_, value in zip(cls._mail_fields, row[1:]):
+                if not value:
+                    continue
+                for address in set(Activity.parse_addresses([value])):
+                    values.append([mail_id, type_, address,
+                            transaction.user, CurrentTimestamp()])
+        if values:
+            cursor.execute(*table.insert([
+                        table.mail, table.type, table.address,
+                        table.create_uid, table.create_date,
+                        ], values))
+
+
+class ElectronicMailThread(ModelSQL):
+    "Electronic Mail Thread"
+    __name__ = 'electronic.mail.thread'
+    message_id = fields.Char("Message-ID", required=True)
+    mail = fields.Many2One('electronic.mail', "Mail", required=True,
+        ondelete='CASCADE')
+    activity = fields.Many2One('activity.activity', "Activity",
+        required=True, ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.message_id, Index.Equality())),
+                Index(t, (t.activity, Index.Equality())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        super().__register__(module_name)
+
+        if not exist:
+            cls._insert_threads()
+
+    @classmethod
+    def update_activities(cls, activities):
+        "Index the message id of the mail of the activities"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_ids in grouped_slice([a.id for a in activities]):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.activity, sub_ids)))
+            cls._insert_threads(sub_ids)
+
+    @classmethod
+    def _insert_threads(cls, activity_ids=None):
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        ElectronicMail = pool.get('electronic.mail')
+        transaction = Transaction()
+        table = cls.__table__()
+        activity = Activity.__table__()
+        mail = ElectronicMail.__table__()
+        cursor = transaction.connection.cursor()
+
+        where = mail.message_id != Null
+        if activity_ids is not None:
+            where &= reduce_ids(activity.id, activity_ids)
+        cursor.execute(*table.insert([
+                    table.message_id, table.mail, table.activity,
+                    table.create_uid, table.create_date,
+                    ],
+                activity.join(mail, condition=activity.mail == mail.id
+                    ).select(
+                    mail.message_id, mail.id, activity.id,
+                    Literal(transaction.user), CurrentTimestamp(),
+                    where=where)))
+
+    @classmethod
+    def get_activities(cls, message_ids):
+        "Return a dictionary with the first activity id of each message id"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {}
+        for sub_ids in grouped_slice(message_ids):
+            cursor.execute(*table.select(
+                    table.message_id, Min(table.activity),
+                    where=table.message_id.in_(list(sub_ids)),
+                    group_by=[table.message_id]))
+            result.update(cursor)
+        return result
@@ -0,0 +1,195 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import atexit
+import base64
+import hashlib
+import multiprocessing
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from email.header import decode_header, make_header
+from email.parser import BytesFeedParser
+
+from html2text import html2text
+
+from trytond.config import config
+
+CACHE_SIZE = config.getint('electronic_mail', 'mime_cache_size',
+    default=32 * 1024 * 1024)
+PARSE_WORKERS = config.getint('electronic_mail', 'activity_parse_workers',
+    default=0)
+MIME_CHUNK_SIZE = 64 * 1024
+# A multiple of the 57 bytes encoded on each line of 76 characters
+BASE64_CHUNK_SIZE = 57 * 1024
+
+
+class ByteLRUCache(object):
+    "A least recently used cache bounded by the size in bytes of its values"
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._values[key]
+            except KeyError:
+                return default
+            self._values.move_to_end(key)
+            return value
+
+    @staticmethod
+    def size_of(value):
+        "Return the size of the value encoded in UTF-8"
+        if isinstance(value, str):
+            if value.isascii():
+                return len(value)
+            return len(value.encode('utf-8'))
+        return len(value)
+
+    def set(self, key, value):
+        size = self.size_of(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._values:
+                self.size -= self._values.pop(key)[1]
+            self._values[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, old_size) = self._values.popitem(last=False)
+                self.size -= old_size
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.size = 0
+
+
+mime_cache = ByteLRUCache(CACHE_SIZE)
+
+
+def html_to_text(content):
+    "Return the plain text alternative of the HTML content"
+    key = ('text', hashlib.sha256(content.encode('utf-8')).hexdigest())
+    text = mime_cache.get(key)
+    if text is None:
+        text = html2text(content)
+        mime_cache.set(key, text)
+    return text
+
+
+def base64_payload(attachment):
+    """Return the base64 encoded data of the attachment
+
+    The data of the attachment is only read when its content hash is not
+    already in the cache.
+    """
+    content_hash = attachment.content_hash
+    if content_hash:
+        payload = mime_cache.get(('base64', content_hash))
+        if payload is not None:
+            return payload
+    data = attachment.data or b''
+    if not content_hash:
+        content_hash = hashlib.sha256(data).hexdigest()
+    payload = ''.join(
+        base64.encodebytes(data[i:i + BASE64_CHUNK_SIZE]).decode('ascii')
+        for i in range(0, len(data), BASE64_CHUNK_SIZE))
+    mime_cache.set(('base64', content_hash), payload)
+    return payload
+
+
+def _decode_text(part):
+    payload = part.get_payload(decode=True)
+    if payload is None:
+        return None
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, 'replace')
+    except LookupError:
+        return payload.decode('utf-8', 'replace')
+
+
+def parse_mail(mail_file, attachments=True):
+    """Return the description and the attachments of the raw mail
+
+    The description is the plain text body or the conversion of the HTML
+    body. The attachments are a list of filename and decoded data, their
+    payloads are not decoded when attachments is False.
+    """
+    if not mail_file:
+        return None, []
+    parser = BytesFeedParser()
+    for i in range(0, len(mail_file), MIME_CHUNK_SIZE):
+        parser.feed(mail_file[i:i + MIME_CHUNK_SIZE])
+    del mail_file
+    message = parser.close()
+
+    plain = html = None
+    parts = []
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        filename = part.get_filename()
+        if filename:
+            if not attachments:
+                continue
+            data = part.get_payload(decode=True)
+            if data is not None:
+                parts.append(
+                    (str(make_header(decode_header(filename))), data))
+        elif part.get_content_type() == 'text/plain' and plain is None:
+            plain = _decode_text(part)
+        elif part.get_content_type() == 'text/html' and html is None:
+            html = _decode_text(part)
+    if plain:
+        description = plain
+    elif html:
+        description = html2text(html)
+    else:
+        description = None
+    return description, parts
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _parse_executor():
+    global _executor
+    if PARSE_WORKERS <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            # The workers do not inherit the database connections
+            _executor = ProcessPoolExecutor(PARSE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+            atexit.register(_executor.shutdown)
+        return _executor
+
+
+def parse_mails(mail_files, attachments=True):
+    """Yield the result of parse_mail for each raw mail keeping the order
+
+    The mails are parsed by a pool of activity_parse_workers processes when
+    the option is set. Only twice the number of workers mails are sent
+    ahead so the memory is bounded.
+    """
+    executor = _parse_executor()
+    if executor is None:
+        for mail_file in mail_files:
+            yield parse_mail(mail_file, attachments)
+        return
+    pending = deque()
+    for mail_file in mail_files:
+        pending.append(executor.submit(
+                parse_mail, mail_file, attachments))
+        del mail_file
+        if len(pending) >= 2 * PARSE_WORKERS:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,69 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql import Null
+from sql.conditionals import Case
+from sql.functions import Lower, Trim
+
+from trytond.model import fields, Index
+from trytond.pool import PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+from .activity import InternalEmailsMixin
+
+
+class ContactMechanism(InternalEmailsMixin, metaclass=PoolMeta):
+    __name__ = 'party.contact_mechanism'
+
+    normalized_email = fields.Char("Normalized Email", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.normalized_email, Index.Equality())))
+
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        exist = table_h.column_exist('normalized_email')
+
+        super().__register__(module_name)
+
+        if not exist:
+            cls._update_normalized_email()
+
+    @classmethod
+    def _update_normalized_email(cls, records=None):
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        value = Case(
+            ((table.type == 'email') & (table.value != Null),
+                Lower(Trim(table.value))),
+            else_=Null)
+        if records is None:
+            cursor.execute(*table.update([table.normalized_email], [value]))
+        else:
+            for sub_ids in grouped_slice(records):
+                cursor.execute(*table.update(
+                        [table.normalized_email], [value],
+                        where=reduce_ids(table.id, list(map(int, sub_ids)))))
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        cls._update_normalized_email(records)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        actions = iter(args)
+        to_update = []
+        for records, values in zip(actions, actions):
+            if values.keys() & {'type', 'value'}:
+                to_update.extend(records)
+        if to_update:
+            cls._update_normalized_email(to_update)
@@ -0,0 +1,122 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import atexit
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from smtplib import SMTPException
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+IDLE_TIMEOUT = config.getint('electronic_mail', 'smtp_idle_timeout',
+    default=60)
+NOOP_INTERVAL = config.getint('electronic_mail', 'smtp_noop_interval',
+    default=10)
+MAX_MESSAGES = config.getint('electronic_mail', 'smtp_max_messages',
+    default=100)
+
+
+def server_key(server):
+    "Return the key of the pool for the smtp.server record"
+    return (Transaction().database.name, server.id,
+        server.write_date or server.create_date)
+
+
+class _Connection(object):
+    __slots__ = ('smtp', 'messages', 'last_used')
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPConnectionPool(object):
+    """Keep the SMTP sessions open to reuse them for the next messages
+
+    An idle session is checked with a NOOP before being reused when it has
+    not been used for noop_interval seconds, it is closed after idle_timeout
+    seconds and once it has sent max_messages messages.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, noop_interval=NOOP_INTERVAL,
+            max_messages=MAX_MESSAGES):
+        self.idle_timeout = idle_timeout
+        self.noop_interval = noop_interval
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)
+
+    @contextmanager
+    def connection(self, key, connect):
+        """Yield an open SMTP session for the key
+
+        connect is called without arguments to open a new session when there
+        is no idle one to reuse.
+        """
+        connection = self._acquire(key)
+        if connection is None:
+            connection = _Connection(connect())
+        try:
+            yield connection.smtp
+        except BaseException:
+            # The state of the session is unknown
+            self._close(connection)
+            raise
+        connection.messages += 1
+        connection.last_used = time.monotonic()
+        if connection.messages >= self.max_messages:
+            self._close(connection)
+        else:
+            with self._lock:
+                self._idle[key].append(connection)
+
+    def _acquire(self, key):
+        now = time.monotonic()
+        expired = []
+        connection = None
+        with self._lock:
+            for idle in self._idle.values():
+                expired.extend(c for c in idle
+                    if now - c.last_used > self.idle_timeout)
+                idle[:] = [c for c in idle
+                    if now - c.last_used <= self.idle_timeout]
+            if self._idle[key]:
+                connection = self._idle[key].pop()
+        for expired_connection in expired:
+            self._close(expired_connection)
+
+        if (connection is not None
+                and now - connection.last_used > self.noop_interval
+                and not self._alive(connection)):
+            self._close(connection)
+            connection = None
+        return connection
+
+    @staticmethod
+    def _alive(connection):
+        try:
+            return connection.smtp.noop()[0] == 250
+        except (SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.smtp.quit()
+        except (SMTPException, OSError):
+            connection.smtp.close()
+
+    def close(self):
+        "Close all the idle sessions"
+        with self._lock:
+            connections = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        for connection in connections:
+            self._close(connection)
+
+
+smtp_pool = SMTPConnectionPool()
+atexit.register(smtp_pool.close)
@@ -0,0 +1,174 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import time
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+
+from sql.functions import CurrentTimestamp
+
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, fields, Index
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+ENABLED = config.getboolean('electronic_mail', 'activity_statistics',
+    default=False)
+RETENTION_DAYS = config.getint('electronic_mail', 'activity_statistics_days',
+    default=30)
+STAGES = [
+    ('create_activity', "Create Activity"),
+    ('guess', "Guess"),
+    ('create_mime_message', "Create MIME Message"),
+    ('send_mail', "Send Mail"),
+    ]
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter(object):
+    "The number of SQL queries executed"
+    __slots__ = ('queries',)
+
+    def __init__(self):
+        self.queries = 0
+
+
+class _CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class _CountingConnection(object):
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+@contextmanager
+def count_queries():
+    """Yield a QueryCounter of the SQL queries executed inside the block
+
+    The queries of nested blocks are counted also by the enclosing ones.
+    """
+    transaction = Transaction()
+    connection = transaction.connection
+    counter = QueryCounter()
+    transaction.connection = _CountingConnection(connection, counter)
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+@contextmanager
+def stage(name, records=0):
+    """Time the block and count its SQL queries
+
+    The measure is logged and stored as an activity.mail.statistic in its
+    own transaction so the measures of the failed blocks are kept too.
+    """
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    failed = True
+    try:
+        with count_queries() as counter:
+            yield
+        failed = False
+    finally:
+        seconds = time.perf_counter() - start
+        queries = counter.queries
+        logger.info("stage %s: %s records in %.3fs with %s queries%s",
+            name, records, seconds, queries, " (failed)" if failed else "",
+            extra={
+                'stage': name,
+                'records': records,
+                'seconds': seconds,
+                'queries': queries,
+                'failed': failed,
+                })
+        Statistic = Pool().get('activity.mail.statistic')
+        try:
+            Statistic.record(name, records, seconds, queries, failed)
+        except Exception:
+            # The statistics must not hide the result of the stage
+            logger.warning("could not store the statistic of stage %s",
+                name, exc_info=True)
+
+
+class ActivityMailStatistic(ModelSQL, ModelView):
+    "Activity Mail Statistic"
+    __name__ = 'activity.mail.statistic'
+    stage = fields.Selection(STAGES, "Stage", required=True, readonly=True)
+    date = fields.Timestamp("Date", required=True, readonly=True)
+    records = fields.Integer("Records", readonly=True,
+        help="The number of mails or activities processed.")
+    seconds = fields.Float("Seconds", digits=(16, 3), readonly=True)
+    queries = fields.Integer("Queries", readonly=True,
+        help="The number of SQL queries executed.")
+    failed = fields.Boolean("Failed", readonly=True,
+        help="The stage raised an error and its transaction was rolled back.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.stage, Index.Equality()),
+                    (t.date, Index.Range(order='DESC'))),
+                Index(t, (t.date, Index.Range())),
+                })
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def record(cls, stage, records, seconds, queries, failed=False):
+        "Store the measure of the stage in a new transaction"
+        user = Transaction().user
+        table = cls.__table__()
+        with Transaction().new_transaction() as transaction:
+            cursor = transaction.connection.cursor()
+            cursor.execute(*table.insert([
+                        table.create_uid, table.create_date, table.stage,
+                        table.date, table.records, table.seconds,
+                        table.queries, table.failed,
+                        ], [[
+                        user, CurrentTimestamp(), stage,
+                        CurrentTimestamp(), records, seconds, queries,
+                        failed,
+                        ]]))
+
+    @classmethod
+    def purge(cls):
+        "Delete the statistics older than activity_statistics_days"
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        limit = datetime.now() - timedelta(days=RETENTION_DAYS)
+        cursor.execute(*table.delete(where=table.date < limit))
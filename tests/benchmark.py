@@ -0,0 +1,298 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Benchmark the ingestion and the sending of activity mails
+
+Run it like the tests, with DB_NAME and TRYTOND_DATABASE_URI set:
+
+    python -m trytond.modules.electronic_mail_activity.tests.benchmark \\
+        --mails 1000 --output benchmark.json
+
+The time, the number of SQL queries and the peak of Python memory of each
+stage are printed and saved as JSON so the results of two releases can be
+compared.
+"""
+import argparse
+import configparser
+import datetime
+import json
+import os
+import random
+import time
+import tracemalloc
+from contextlib import contextmanager
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+
+import trytond
+from trytond.modules.company.tests import (
+    create_company, create_employee, set_company)
+from trytond.modules.electronic_mail_activity.activity import (
+    SendActivityMailMixin)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import CONTEXT, DB_NAME, USER, activate_module
+from trytond.transaction import Transaction
+
+from .tools import SMTPStandIn, count_queries
+
+WORDS = ('order invoice delivery quotation price product customer please '
+    'thanks regards meeting tomorrow attached document payment').split()
+
+
+@contextmanager
+def measure(results, name):
+    "Record the seconds, the queries and the memory peak of the block"
+    tracemalloc.start()
+    start = time.perf_counter()
+    with count_queries() as counter:
+        yield
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[name] = {
+        'seconds': round(seconds, 4),
+        'queries': counter.queries,
+        'peak_memory': peak,
+        }
+
+
+def text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def synthetic_message(rng, index, parties, previous, options):
+    """Return a MIME message looking like a customer mail
+
+    Some mails reply to a previous one, some have an HTML alternative and
+    some have attachments, a few of them identical.
+    """
+    body = text(rng, options.body_size)
+    message = MIMEMultipart()
+    alternative = MIMEMultipart('alternative')
+    alternative.attach(MIMEText(body, 'plain', _charset='utf-8'))
+    if index % 4 == 0:
+        alternative.attach(MIMEText(
+                '<html><body><p>%s</p></body></html>' % body, 'html',
+                _charset='utf-8'))
+    message.attach(alternative)
+    if options.attachment_every and index % options.attachment_every == 0:
+        if index % (options.attachment_every * 3) == 0:
+            # The same document sent again
+            data = b'%PDF-1.4 ' + b'0' * options.attachment_size
+        else:
+            data = os.urandom(options.attachment_size)
+        attachment = MIMEApplication(data, 'pdf')
+        attachment.add_header('Content-Disposition', 'attachment',
+            filename='document-%s.pdf' % index)
+        message.attach(attachment)
+
+    message['Message-Id'] = make_msgid()
+    message['Date'] = formatdate(localtime=True)
+    message['From'] = rng.choice(parties)
+    message['To'] = 'sales@example.com'
+    message['Subject'] = text(rng, 40)
+    if previous and rng.random() < options.reply_ratio:
+        parent = rng.choice(previous)
+        message['In-Reply-To'] = parent['Message-Id']
+        message['References'] = ' '.join(filter(None, [
+                    parent['References'], parent['Message-Id']]))
+    return message
+
+
+def setup(options, smtp_address):
+    pool = Pool()
+    Mailbox = pool.get('electronic.mail.mailbox')
+    Configuration = pool.get('activity.configuration')
+    Party = pool.get('party.party')
+    ContactMechanism = pool.get('party.contact_mechanism')
+    SMTPServer = pool.get('smtp.server')
+    User = pool.get('res.user')
+
+    company = create_company()
+    employee = create_employee(company)
+    ContactMechanism.create([{
+                'party': employee.party.id,
+                'type': 'email',
+                'value': 'sales@example.com',
+                }])
+    pending, processed, sent = Mailbox.create([
+            {'name': 'Pending'},
+            {'name': 'Processed'},
+            {'name': 'Sent'},
+            ])
+    config = Configuration(1)
+    config.employee = employee
+    config.pending_mailbox = pending
+    config.processed_mailbox = processed
+    config.activity_batch_size = options.batch_size
+    config.save()
+
+    emails = ['customer%s@example.com' % i for i in range(options.parties)]
+    Party.create([{
+                'name': 'Customer %s' % i,
+                'contact_mechanisms': [('create', [{
+                                'type': 'email',
+                                'value': email,
+                                }])],
+                } for i, email in enumerate(emails)])
+
+    server, = SMTPServer.create([{
+                'name': 'Benchmark',
+                'smtp_server': smtp_address[0],
+                'smtp_port': smtp_address[1],
+                'smtp_email': 'sales@example.com',
+                'state': 'done',
+                }])
+    user = User(Transaction().user)
+    User.write([user], {
+            'employees': [('add', [employee.id])],
+            'employee': employee.id,
+            'smtp_server': server.id,
+            'mailbox': sent.id,
+            })
+    return company, pending, emails
+
+
+def benchmark_ingest(results, options, pending, emails):
+    pool = Pool()
+    ElectronicMail = pool.get('electronic.mail')
+    Activity = pool.get('activity.activity')
+
+    rng = random.Random(options.seed)
+    messages = []
+    with measure(results, 'generate'):
+        for index in range(options.mails):
+            message = synthetic_message(rng, index, emails, messages, options)
+            ElectronicMail.create_from_mail(message, pending)
+            messages.append(message)
+
+    with measure(results, 'create_activity'):
+        Activity.create_activity()
+    # The tasks are not run inside the transaction so the claimed mails are
+    # processed as the tasks would do
+    mails = ElectronicMail.search([
+            ('mailbox', '=', pending.id),
+            ('activity_claimed_at', '!=', None),
+            ], order=[('date', 'ASC'), ('id', 'ASC')])
+    with measure(results, '_create_activity'):
+        for i in range(0, len(mails), options.batch_size):
+            ElectronicMail._create_activity(
+                mails[i:i + options.batch_size])
+
+    activities = Activity.search([
+            ('mail', 'in', [m.id for m in mails]),
+            ])
+    with measure(results, 'guess'):
+        Activity.guess(activities)
+    return activities
+
+
+def benchmark_send(results, options, activities):
+    pool = Pool()
+    Activity = pool.get('activity.activity')
+
+    activities = Activity.copy(activities[:options.send], default={
+            'direction': 'outgoing',
+            })
+    user = Activity.check_activity_user_info()
+    with measure(results, 'send_mails'):
+        failures = Activity.send_mails(activities, user)
+    results['send_mails']['failures'] = len(failures)
+
+
+def benchmark_mixin_write(results, options):
+    pool = Pool()
+    ActivityType = pool.get('activity.type')
+
+    models = [m for _, m in pool.iterobject()
+        if issubclass(m, SendActivityMailMixin)]
+    activity_type = ActivityType.search([], limit=1)
+    for Model in models:
+        records = Model.search([], limit=options.send)
+        if records and activity_type:
+            break
+    else:
+        results['mixin_write'] = {
+            'skipped': 'No record of a model using SendActivityMailMixin',
+            }
+        return
+    with measure(results, 'mixin_write'):
+        Model.write(records, {
+                'activity_type': activity_type[0].id,
+                'activity_subject': 'Benchmark',
+                })
+    results['mixin_write']['model'] = Model.__name__
+    results['mixin_write']['records'] = len(records)
+
+
+def module_version():
+    parser = configparser.ConfigParser()
+    parser.read(os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), 'tryton.cfg'))
+    return parser.get('tryton', 'version')
+
+
+def run(options):
+    activate_module('electronic_mail_activity')
+    results = {}
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction, \
+            SMTPStandIn() as smtp_server:
+        try:
+            company, pending, emails = setup(
+                options, smtp_server.server_address)
+            with set_company(company):
+                activities = benchmark_ingest(
+                    results, options, pending, emails)
+                benchmark_send(results, options, activities)
+                benchmark_mixin_write(results, options)
+        finally:
+            transaction.rollback()
+    return {
+        'module': module_version(),
+        'trytond': trytond.__version__,
+        'database': os.environ.get('TRYTOND_DATABASE_URI', ''),
+        'date': datetime.datetime.now().isoformat(),
+        'options': vars(options),
+        'results': results,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mails', type=int, default=1000,
+        help="the number of synthetic mails")
+    parser.add_argument('--parties', type=int, default=100,
+        help="the number of parties sending the mails")
+    parser.add_argument('--send', type=int, default=100,
+        help="the number of mails sent and of records written")
+    parser.add_argument('--batch-size', type=int, default=100,
+        help="the number of mails processed by each task")
+    parser.add_argument('--body-size', type=int, default=4 * 1024,
+        help="the size of the body of the mails in bytes")
+    parser.add_argument('--attachment-size', type=int, default=200 * 1024,
+        help="the size of the attachments in bytes")
+    parser.add_argument('--attachment-every', type=int, default=5,
+        help="add an attachment to one mail out of this number")
+    parser.add_argument('--reply-ratio', type=float, default=0.3,
+        help="the ratio of mails replying to a previous one")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="the JSON file to save the results")
+    options = parser.parse_args(argv)
+
+    report = run(options)
+    for name, result in report['results'].items():
+        print(name, ' '.join('%s=%s' % i for i in result.items()))
+    if options.output:
+        with open(options.output, 'w') as file_:
+            json.dump(report, file_, indent=2)
+
+
+if __name__ == '__main__':
+    main()
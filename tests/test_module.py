@@ -1,14 +1,293 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import unittest
+
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, create_employee, set_company)
+from trytond.modules.electronic_mail_activity.activity import (
+    SendActivityMailMixin, quote_description)
+from trytond.modules.electronic_mail_activity.smtp import SMTPConnectionPool
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+from .tools import SMTPStandIn, count_queries, create_mail
+
+
+class SMTPConnectionPoolTestCase(unittest.TestCase):
+    'Test SMTPConnectionPool'
+
+    def send(self, pool, server, count, key='server'):
+        for i in range(count):
+            with pool.connection(key, server.connect) as smtp:
+                smtp.sendmail('from@example.com', ['to@example.com'],
+                    'Subject: %s\r\n\r\nHello' % i)
+
+    def test_reuse(self):
+        'Test the sessions are reused'
+        pool = SMTPConnectionPool()
+        with SMTPStandIn() as server:
+            self.send(pool, server, 10)
+            pool.close()
+
+        self.assertEqual(len(server.messages), 10)
+        self.assertEqual(server.connections, 1)
+
+    def test_key(self):
+        'Test the sessions are not shared between keys'
+        pool = SMTPConnectionPool()
+        with SMTPStandIn() as server:
+            self.send(pool, server, 2, key='first')
+            self.send(pool, server, 2, key='second')
+            pool.close()
+
+        self.assertEqual(server.connections, 2)
+
+    def test_max_messages(self):
+        'Test a session is closed after max messages'
+        pool = SMTPConnectionPool(max_messages=3)
+        with SMTPStandIn() as server:
+            self.send(pool, server, 7)
+            pool.close()
+
+        self.assertEqual(len(server.messages), 7)
+        self.assertEqual(server.connections, 3)
+
+    def test_idle_timeout(self):
+        'Test an idle session is not reused after the timeout'
+        pool = SMTPConnectionPool(idle_timeout=-1)
+        with SMTPStandIn() as server:
+            self.send(pool, server, 3)
+            pool.close()
+
+        self.assertEqual(server.connections, 3)
+
+    def test_noop(self):
+        'Test an idle session is checked and replaced when dead'
+        pool = SMTPConnectionPool(noop_interval=-1)
+        with SMTPStandIn() as server:
+            self.send(pool, server, 2)
+            self.assertEqual(server.noops, 1)
+
+            # Break the idle session
+            with pool._lock:
+                pool._idle['server'][0].smtp.close()
+            self.send(pool, server, 1)
+            pool.close()
+
+        self.assertEqual(len(server.messages), 3)
+        self.assertEqual(server.connections, 2)
+
+    def test_error(self):
+        'Test a session is discarded on error'
+        pool = SMTPConnectionPool()
+        with SMTPStandIn() as server:
+            with self.assertRaises(ValueError):
+                with pool.connection('server', server.connect):
+                    raise ValueError
+            self.send(pool, server, 1)
+            pool.close()
+
+        self.assertEqual(server.connections, 2)
+
+
+class QuoteDescriptionTestCase(unittest.TestCase):
+    'Test quote_description'
+    description = 'Hello\n> Previous\n> > Older\nBye'
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+    def test_quote(self):
+        'Test the whole thread is quoted'
+        self.assertEqual(quote_description(self.description),
+            '> Hello\n> > Previous\n> > > Older\n> Bye')
+
+    def test_quote_depth(self):
+        'Test the quote levels are limited'
+        self.assertEqual(quote_description(self.description, 2),
+            '> Hello\n> > Previous\n> Bye')
+
+    def test_quote_latest(self):
+        'Test only the latest message is quoted'
+        self.assertEqual(quote_description(self.description, 1),
+            '> Hello\n> Bye')
+
+    def test_quote_empty(self):
+        'Test an empty description'
+        self.assertEqual(quote_description(None), None)
 
 
 class ElectronicMailActivityTestCase(CompanyTestMixin, ModuleTestCase):
     'Test ElectronicMailActivity module'
     module = 'electronic_mail_activity'
 
+    def setup_mailboxes(self):
+        pool = Pool()
+        Mailbox = pool.get('electronic.mail.mailbox')
+        Configuration = pool.get('activity.configuration')
+
+        company = create_company()
+        employee = create_employee(company)
+        pending, processed = Mailbox.create([
+                {'name': 'Pending'},
+                {'name': 'Processed'},
+                ])
+        config = Configuration(1)
+        config.employee = employee
+        config.pending_mailbox = pending
+        config.processed_mailbox = processed
+        config.save()
+        return company, pending, processed
+
+    @with_transaction()
+    def test_create_activity_duplicate_queries(self):
+        'Test duplicated mails are detected with a constant number of queries'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Activity = pool.get('activity.activity')
+
+        company, pending, processed = self.setup_mailboxes()
+        with set_company(company):
+            counts = []
+            for size in [5, 50]:
+                mail_ids = [create_mail(pending, 'Mail %s' % i).id
+                    for i in range(size)]
+                ElectronicMail._create_activity(
+                    ElectronicMail.browse(mail_ids))
+                self.assertEqual(
+                    Activity.search([('mail', 'in', mail_ids)], count=True),
+                    size)
+
+                # Move them back as if they were delivered again
+                ElectronicMail.write(ElectronicMail.browse(mail_ids), {
+                        'mailbox': pending.id,
+                        })
+                with count_queries() as counter:
+                    ElectronicMail._create_activity(
+                        ElectronicMail.browse(mail_ids))
+                counts.append(counter.queries)
+
+                self.assertEqual(
+                    Activity.search([('mail', 'in', mail_ids)], count=True),
+                    size)
+                self.assertTrue(all(m.mailbox == processed
+                        for m in ElectronicMail.browse(mail_ids)))
+            self.assertEqual(counts[0], counts[1])
+
+    @with_transaction()
+    def test_guess_thread(self):
+        'Test the party and the resource are guessed for a thread'
+        pool = Pool()
+        ElectronicMail = pool.get('electronic.mail')
+        Activity = pool.get('activity.activity')
+        Configuration = pool.get('activity.configuration')
+        Party = pool.get('party.party')
+        Model = pool.get('ir.model')
+        Reference = pool.get('activity.reference')
+
+        company, pending, processed = self.setup_mailboxes()
+        employee = Configuration(1).employee
+        Party.write([employee.party], {
+                'contact_mechanisms': [('create', [{
+                                'type': 'email',
+                                'value': 'sales@example.com',
+                                }])],
+                })
+        customer, = Party.create([{
+                    'name': 'Customer',
+                    'contact_mechanisms': [('create', [{
+                                    'type': 'email',
+                                    'value': 'Customer@Example.com ',
+                                    }])],
+                    }])
+        model, = Model.search([('model', '=', 'party.party')])
+        Reference.create([{'model': model.id}])
+
+        with set_company(company):
+            first = create_mail(pending, 'Order')
+            ElectronicMail._create_activity([first])
+            activity, = Activity.search([('mail', '=', first.id)])
+            # The company emails are not used to guess the party
+            self.assertEqual(activity.party, customer)
+            self.assertEqual(activity.resource, None)
+            self.assertEqual(activity.contacts, ())
+            Activity.write([activity], {'resource': str(customer)})
+
+            reply = create_mail(pending, 'Re: Order',
+                in_reply_to=first.message_id)
+            other = create_mail(pending, 'Invoice')
+            ElectronicMail._create_activity([reply, other])
+            reply_activity, = Activity.search([('mail', '=', reply.id)])
+            other_activity, = Activity.search([('mail', '=', other.id)])
+
+            # The reply follows the resource of its thread
+            self.assertEqual(reply_activity.resource, customer)
+            # A new thread gets the party of the last activity of the sender
+            self.assertEqual(other_activity.party, customer)
+            self.assertEqual(other_activity.resource, None)
+            self.assertEqual(other_activity.contacts, ())
+
+    @with_transaction()
+    def test_send_activity_mail_mixin_write(self):
+        'Test an activity is created for each record written at once'
+        pool = Pool()
+        Activity = pool.get('activity.activity')
+        ActivityType = pool.get('activity.type')
+        ContactMechanism = pool.get('party.contact_mechanism')
+        Model = pool.get('ir.model')
+        Party = pool.get('party.party')
+        Reference = pool.get('activity.reference')
+        User = pool.get('res.user')
+
+        class Written(object):
+            @classmethod
+            def write(cls, *args):
+                cls.written = args
+
+        class Records(SendActivityMailMixin, Written):
+            pass
+
+        company = create_company()
+        employee = create_employee(company)
+        User.write([User(Transaction().user)], {
+                'employees': [('add', [employee.id])],
+                'employee': employee.id,
+                })
+        contact, first, second = Party.create([
+                {'name': 'Contact'},
+                {'name': 'First'},
+                {'name': 'Second'},
+                ])
+        records = ContactMechanism.create([{
+                    'party': p.id,
+                    'type': 'email',
+                    'value': '%s@example.com' % p.name.lower(),
+                    } for p in [first, second]])
+        model, = Model.search([('model', '=', 'party.contact_mechanism')])
+        Reference.create([{'model': model.id}])
+        activity_type, = ActivityType.create([{'name': 'Call'}])
+
+        with set_company(company):
+            Records.write(records, {
+                    'activity_type': activity_type.id,
+                    'activity_subject': 'Called',
+                    'activity_contact': contact.id,
+                    })
+
+            # The activity fields are not written on the records
+            written_records, values = Records.written
+            self.assertEqual(written_records, records)
+            self.assertEqual(values['activity_type'], None)
+            self.assertEqual(values['activity_contact'], None)
+
+            for record in records:
+                activity, = Activity.search([
+                        ('resource', '=', str(record)),
+                        ])
+                self.assertEqual(activity.subject, 'Called')
+                self.assertEqual(activity.activity_type, activity_type)
+                self.assertEqual(activity.party, record.party)
+                self.assertEqual(activity.employee, employee)
+                self.assertEqual(
+                    [c.party for c in activity.contacts], [contact])
+
 
 del ModuleTestCase
@@ -0,0 +1,92 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import smtplib
+import socketserver
+import threading
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+
+from trytond.modules.electronic_mail_activity.statistic import count_queries
+from trytond.pool import Pool
+
+__all__ = ['count_queries', 'SMTPStandIn', 'create_mail']
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 localhost SMTP stand-in')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode('ascii', 'replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 localhost')
+            elif command.startswith(('MAIL', 'RCPT', 'RSET')):
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                with server.lock:
+                    server.noops += 1
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for line in self.rfile:
+                    if line in {b'.\r\n', b'.\n'}:
+                        break
+                    data.append(line)
+                with server.lock:
+                    server.messages.append(b''.join(data))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    "A local SMTP server which keeps the messages received"
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.noops = 0
+        self.messages = []
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    def connect(self):
+        return smtplib.SMTP(*self.server_address)
+
+
+def create_mail(mailbox, subject, body='Hello', in_reply_to=None):
+    pool = Pool()
+    ElectronicMail = pool.get('electronic.mail')
+
+    message = MIMEText(body, 'plain', _charset='utf-8')
+    message['Message-Id'] = make_msgid()
+    message['Date'] = formatdate(localtime=True)
+    message['From'] = 'customer@example.com'
+    message['To'] = 'sales@example.com'
+    message['Subject'] = subject
+    if in_reply_to:
+        message['In-Reply-To'] = in_reply_to
+        message['References'] = in_reply_to
+    return ElectronicMail.create_from_mail(message, mailbox)